@@ -0,0 +1,65 @@
+import concurrent.futures
+import copy
+import logging
+import threading
+from typing import Callable
+
+# Threads writing artifacts, and how many artifacts can wait to be written before submitting another blocks.
+THREADS = 2
+PENDING = 8
+
+
+# A Writer writes artifacts (mermaid diagrams, images and chip files) on a bounded pool of background threads, so the
+# flow keeps running while the previous stage's output is written. Each artifact is written from a snapshot of its
+# values taken when it's submitted, so later stages are free to change them. flush() waits for every artifact and
+# raises the first error writing any of them, and leaving a with block flushes the writer.
+class Writer:
+    def __init__(self, threads: int = THREADS, pending: int = PENDING):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="artifacts")
+        self.slots = threading.BoundedSemaphore(pending)
+        self.futures: list[concurrent.futures.Future] = []
+
+    # submit(file, write, *values, snapshot) calls write(*values, file) in the background, on copies of values unless
+    # snapshot is False (for values nothing changes any more). Copying recurses, so values as deep as a design's
+    # cones should be frozen by the caller and submitted with snapshot False. It blocks while the writer is full.
+    def submit(self, file: str, write: Callable, *values, snapshot: bool = True):
+        logging.info(f"Writing file {file}")
+        if snapshot:
+            values = copy.deepcopy(values)
+
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(write, *values, file)
+        except:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    # flush() waits until every artifact submitted is written, raising the first error writing one.
+    def flush(self):
+        (futures, self.futures) = (self.futures, [])
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.pool.shutdown()
+
+    def __enter__(self) -> "Writer":
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type == None:
+            self.close()
+            return
+
+        # Don't hide the error already leaving the with block behind one writing an artifact.
+        try:
+            self.close()
+        except Exception:
+            logging.exception("Failed writing an artifact")
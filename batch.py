@@ -0,0 +1,261 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import time
+import edatool
+import technology
+
+# Libraries loaded by this process, keyed by (path, content hash), so each worker loads a library once.
+libraries: dict[tuple[str, str], technology.Technology] = {}
+
+
+# library(args) returns the standard cell library args ask for, loading it the first time it's used.
+def library(args) -> technology.Technology:
+    key = (os.path.abspath(args.standard_cells),
+           technology.library_hash(args.standard_cells))
+    if not key in libraries:
+        libraries[key] = technology.load(
+            args.standard_cells, cache_dir=None if args.no_cache else args.cache_dir)
+    return libraries[key]
+
+
+# designs(paths) expands verilog files, directories (searched recursively for .v files) and manifests
+# (files listing one path per line, relative to the manifest, with # comments) into verilog files.
+def designs(paths: list[str]) -> list[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (directory, subdirectories, names) in os.walk(path):
+                subdirectories.sort()
+                files += [os.path.join(directory, name)
+                          for name in sorted(names) if name.endswith(".v")]
+        elif path.endswith(".v"):
+            files.append(path)
+        else:
+            with open(path) as f:
+                entries = [line.split("#")[0].strip() for line in f]
+            files += designs([os.path.join(os.path.dirname(path), entry)
+                              for entry in entries if entry])
+    return files
+
+
+# jobs(files, args) returns the arguments to run each design with. Every design gets its own directory
+# in args.output, named after the file, and runs single process since designs run in parallel instead.
+def jobs(files: list[str], args) -> list[argparse.Namespace]:
+    names = {}
+    result = []
+    for file in files:
+        name = os.path.splitext(os.path.basename(file))[0]
+        names[name] = names.get(name, 0) + 1
+        if names[name] > 1:
+            name = f"{name}-{names[name]}"
+        result.append(argparse.Namespace(**dict(vars(args), filename=file,
+                                                output=os.path.join(args.output, name), jobs=1)))
+    return result
+
+
+# run_design(args) runs edatool on one design, logging to edatool.log in its output directory. It
+# returns a summary of the run, which records (rather than raises) any failure.
+def run_design(args) -> dict:
+    start = time.perf_counter()
+    summary = {"design": os.path.basename(args.output), "filename": args.filename,
+               "output": args.output, "ok": False, "error": None}
+
+    os.makedirs(args.output, exist_ok=True)
+    root = logging.getLogger()
+    (handlers, level) = (root.handlers, root.level)
+    handler = logging.FileHandler(os.path.join(
+        args.output, "edatool.log"), mode="w")
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    root.handlers = [handler]
+    root.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    try:
+        c = edatool.run(args, library(args), edatool.open_checkpoints(args))
+        summary.update(ok=True, cells=len(c.cells),
+                       dropped_routes=c.dropped_routes)
+    except SystemExit:
+        # edatool exits when verification finds a counterexample, after logging it.
+        summary["error"] = "verification failed"
+    except Exception as e:
+        logging.exception(f"Failed on {args.filename}")
+        summary["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        root.handlers = handlers
+        root.setLevel(level)
+        handler.close()
+
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+# log_summary(summaries, elapsed) logs a table of the runs, with totals.
+def log_summary(summaries: list[dict], elapsed: float):
+    width = max([len(summary["design"]) for summary in summaries] + [6])
+    logging.info(f"{'design':<{width}}  status  seconds  cells  dropped")
+    for summary in summaries:
+        if summary["ok"]:
+            logging.info(
+                f"{summary['design']:<{width}}  ok      {summary['seconds']:7.2f}  {summary['cells']:5}  {summary['dropped_routes']:7}")
+        else:
+            logging.info(
+                f"{summary['design']:<{width}}  FAILED  {summary['seconds']:7.2f}  {summary['error']}")
+
+    failed = sum(1 for summary in summaries if not summary["ok"])
+    dropped = sum(summary.get("dropped_routes", 0) for summary in summaries)
+    logging.info(
+        f"{len(summaries)} designs in {elapsed:.2f} s ({failed} failed, {dropped} dropped routes)")
+
+
+# A Handler serves one connection to the server. Each line the client sends is a JSON job
+# {"filename": ..., "standard_cells": ..., "output": ..., "options": {...}}, where options overrides
+# the server's edatool options by name. Once the client shuts down its side, the handler answers
+# with one JSON summary per job, in order.
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        futures = []
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                settings = dict(vars(self.server.args))
+                settings.update((name, value) for (name, value) in job.get(
+                    "options", {}).items() if name in settings)
+                settings.update(filename=job["filename"], output=job["output"], jobs=1,
+                                standard_cells=job.get("standard_cells", self.server.args.standard_cells))
+                args = argparse.Namespace(**settings)
+                futures.append(self.server.pool.submit(run_design, args))
+            except (ValueError, KeyError, TypeError) as e:
+                futures.append(f"Bad job {line!r}: {e}")
+
+        for future in futures:
+            if isinstance(future, str):
+                summary = {"ok": False, "error": future}
+            else:
+                summary = future.result()
+            self.wfile.write((json.dumps(summary) + "\n").encode())
+
+        if self.server.checkpoints != None:
+            self.server.checkpoints.evict()
+
+
+# serve(args) runs designs sent over the Unix socket at args.serve until interrupted.
+def serve(args):
+    if os.path.exists(args.serve):
+        os.remove(args.serve)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool, \
+            socketserver.ThreadingUnixStreamServer(args.serve, Handler) as server:
+        server.args = args
+        server.pool = pool
+        server.checkpoints = edatool.open_checkpoints(args)
+        logging.info(
+            f"Serving on {args.serve} with {args.jobs} processes")
+
+        # Stop on SIGTERM as on ^C, so the socket is removed either way.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(args.serve)
+
+
+# submit(args, files, given) sends files to the server at args.connect and returns its summaries. Only the edatool
+# options named in given, the ones the client set, are sent, so the server's own apply to the rest.
+def submit(args, files: list[str], given: set[str]) -> list[dict]:
+    options = {name: value for (name, value) in vars(args).items()
+               if name in given and name in vars(edatool.options.parse_args([]))}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(args.connect)
+        for job in jobs(files, args):
+            s.sendall((json.dumps({"filename": os.path.abspath(job.filename),
+                                   "standard_cells": os.path.abspath(args.standard_cells),
+                                   "output": os.path.abspath(job.output),
+                                   "options": options}) + "\n").encode())
+        s.shutdown(socket.SHUT_WR)
+        with s.makefile() as f:
+            return [json.loads(line) for line in f]
+
+
+parser = argparse.ArgumentParser(
+    prog="batch.py",
+    description="batch.py runs edatool.py over many designs, loading the standard cell library once per process. "
+    "Designs run in parallel over -j processes, each writing its chip and edatool.log to a directory "
+    "named after it in the output directory, and a summary is written to summary.json.",
+    epilog="(c) 2023 William Barkoff",
+    parents=[edatool.options])
+
+parser.add_argument(
+    'standard_cells', help="The JSON standard cell description file.")
+parser.add_argument('designs', nargs='*',
+                    help="Verilog files, directories of them, or manifests listing one per line.")
+parser.add_argument('--serve', metavar="SOCKET",
+                    help="Serve designs sent to the Unix socket SOCKET instead of running the designs given.")
+parser.add_argument('--connect', metavar="SOCKET",
+                    help="Send the designs given to the server at SOCKET instead of running them here.")
+
+
+# given(argv) returns the names of the edatool options argv (the command line if None) sets, rather than leaving at
+# their defaults.
+def given(argv: list[str] | None = None) -> set[str]:
+    # argparse only fills in the defaults of options missing from the namespace it's given.
+    unset = object()
+    names = vars(edatool.options.parse_args([]))
+    args = parser.parse_intermixed_args(
+        argv, argparse.Namespace(**{name: unset for name in names}))
+    return {name for name in names if getattr(args, name) is not unset}
+
+
+def main():
+    args = parser.parse_intermixed_args()
+
+    logging.basicConfig(format='%(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
+
+    if args.serve:
+        # Compile the library once up front, so the workers all load it from the cache.
+        library(args)
+        serve(args)
+        return
+
+    start = time.perf_counter()
+    files = designs(args.designs)
+    if args.connect:
+        summaries = submit(args, files, given())
+    else:
+        library(args)
+        if args.jobs > 1 and len(files) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+                summaries = list(pool.map(run_design, jobs(files, args)))
+        else:
+            summaries = [run_design(job) for job in jobs(files, args)]
+
+        checkpoints = edatool.open_checkpoints(args)
+        if checkpoints != None:
+            checkpoints.evict()
+
+    log_summary(summaries, time.perf_counter() - start)
+
+    os.makedirs(args.output, exist_ok=True)
+    file = os.path.join(args.output, "summary.json")
+    logging.info(f"Writing file {file}")
+    with open(file, "w") as f:
+        json.dump(summaries, f, indent=2)
+
+    if any(not summary["ok"] for summary in summaries):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
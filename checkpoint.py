@@ -0,0 +1,110 @@
+import hashlib
+import logging
+import os
+import pickle
+import time
+
+# Checkpoint entries are pickles named after their key, in the "checkpoints" directory of the cache.
+# Bump VERSION whenever a stage's output changes shape, so old checkpoints are never hit.
+SUFFIX = ".checkpoint"
+VERSION = 7
+
+
+# key(*parts) returns a content address for parts, which are strings, bytes or anything with a stable repr.
+def key(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in (VERSION, *parts):
+        data = part if isinstance(part, bytes) else repr(part).encode()
+        digest.update(len(data).to_bytes(8, "little"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+# file_hash(path) returns the content hash of the file at path.
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# A Checkpoints is a content-addressed store of pickled stage outputs. Entries are evicted once they
+# are older than max_age seconds, and least recently used first once the store grows past max_bytes.
+class Checkpoints:
+    def __init__(self, cache_dir: str, max_bytes: int, max_age: float):
+        self.directory = os.path.join(cache_dir, "checkpoints")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __entry__(self, key: str) -> str:
+        return os.path.join(self.directory, key + SUFFIX)
+
+    # get(key) returns (True, value) for a stored checkpoint, or (False, None) if there isn't one.
+    def get(self, key: str) -> tuple[bool, object]:
+        path = self.__entry__(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return (False, None)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable checkpoint {path}: {e}")
+            return (False, None)
+
+        # Reading an entry makes it recently used, unless another process has just evicted it.
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return (True, value)
+
+    # put(key, value) stores value under key. A value that can't be stored (too deep to pickle, or the disk is
+    # full) is only logged, since the run doesn't need its checkpoint.
+    def put(self, key: str, value: object):
+        path = self.__entry__(key)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, path)
+        except Exception as e:
+            logging.warning(f"Not checkpointing {path}: {e}")
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
+
+    # evict() removes expired entries (and temporary files), then the least recently used ones until the store fits in
+    # max_bytes. Another process evicting the same store can remove an entry first, so entries that vanish are skipped.
+    def evict(self):
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                # Temporary files left by a run that died writing one are removed once they expire.
+                if entry.name.endswith(".tmp") and now - entry.stat().st_mtime > self.max_age:
+                    os.remove(entry.path)
+                    continue
+                if not entry.name.endswith(SUFFIX):
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > self.max_age:
+                    os.remove(entry.path)
+                    logging.debug(f"Evicted expired checkpoint {entry.name}")
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                logging.debug(f"Evicted checkpoint {os.path.basename(path)}")
+            except FileNotFoundError:
+                pass
+            total -= size
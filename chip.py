@@ -1,45 +1,72 @@
 from matplotlib import patheffects
 from matplotlib.axes import Axes
 from matplotlib.figure import Figure
-import matplotlib.pyplot as plt
 from matplotlib.path import Path
 import matplotlib.patches as patches
+from matplotlib.collections import PatchCollection
+from matplotlib.colors import to_rgba
 import jsonpickle
-import copy
+import jsonpickle.ext.numpy as jsonpickle_numpy
+import numpy as np
 import logging
+import concurrent.futures
+import gzip
+import os
 
 from eda_tree import EDANode
-from technology import Technology
+from technology import Technology, Layer, HORIZONTAL, VERTICAL
+import router
+import placer
+import routes
 
 PIN_SIZE = (2, 2)
 STDCELL_SIZE = (8, 8)
+BIN_SIZE = STDCELL_SIZE
 
+# PathFinder negotiation: the cost of sharing a cell starts at PRESENT_FACTOR and grows by PRESENT_GROWTH each
+# iteration, and each unit of overuse adds HISTORY_FACTOR to a cell's cost for good. A net's search is confined
+# to its pins' bounding box grown by BOX_MARGIN cells, unless it can't be routed inside it.
+PRESENT_FACTOR = 0.5
+PRESENT_GROWTH = 1.5
+HISTORY_FACTOR = 1.0
+BOX_MARGIN = 3
+MAX_ITERATIONS = 50
 
-def __print_arr__(arr):
-    print('\n'.join(' '.join(f"{x:02d}" for x in row) for row in arr))
+# Global routing divides the chip into square GCells of GCELL_SIZE cells, and negotiates for at most GLOBAL_ITERATIONS
+# iterations. A net's detailed route is confined to the GCells its global route crosses, grown by CORRIDOR_MARGIN.
+GCELL_SIZE = 8
+GLOBAL_ITERATIONS = 8
+CORRIDOR_MARGIN = 1
+
+# Routing against a layer's preferred direction costs WRONG_WAY_COST times as much.
+WRONG_WAY_COST = 3
+
+# Version of the format dump_def writes and load reads.
+DEF_VERSION = 1
+
+# Chips are drawn downsampled once they are more than this many cells on a side.
+MAX_IMAGE_CELLS = 1000
+
+# Colors routes on each layer are drawn in, bottom up, cycling if there are more layers.
+LAYER_COLORS = ["blue", "red", "green", "purple", "brown", "olive"]
 
+jsonpickle_numpy.register_handlers()
 
-def __find_min_neighbor__(arr: list[list[int]], i: int, j: int):
-    minimum = -1
-    neighbor = (-1, -1)
 
-    if i+1 < len(arr) and arr[i+1][j] > 0 and (arr[i+1][j] < minimum or minimum == -1):
-        minimum = arr[i+1][j]
-        neighbor = (i+1, j)
-    if i-1 >= 0 and arr[i-1][j] > 0 and (arr[i-1][j] < minimum or minimum == -1):
-        minimum = arr[i-1][j]
-        neighbor = (i-1, j)
-    if j+1 < len(arr[0]) and arr[i][j+1] > 0 and (arr[i][j+1] < minimum or minimum == -1):
-        minimum = arr[i][j+1]
-        neighbor = (i, j+1)
-    if j-1 >= 0 and arr[i][j-1] > 0 and (arr[i][j-1] < minimum or minimum == -1):
-        minimum = arr[i][j-1]
-        neighbor = (i, j-1)
+def __print_arr__(arr):
+    print('\n'.join(' '.join(f"{x:02d}" for x in row) for row in arr))
+
 
-    return neighbor
+# __bins__(position) returns the keys of the spatial index bins that the box position covers.
+def __bins__(position) -> list[tuple[int, int]]:
+    return [(i, j)
+            for i in range(int(position.x0 // BIN_SIZE[0]), int((position.x1 - 1) // BIN_SIZE[0]) + 1)
+            for j in range(int(position.y0 // BIN_SIZE[1]), int((position.y1 - 1) // BIN_SIZE[1]) + 1)]
 
 
 class Position():
+    __slots__ = ("x0", "x1", "y0", "y1")
+
     def __init__(self, x0, y0, x1, y1):
         self.x0 = x0
         self.x1 = x1
@@ -48,6 +75,8 @@ class Position():
 
 
 class ChipCell():
+    __slots__ = ("name", "position", "type", "id")
+
     def __init__(self, name: str, position: Position, type: str, id: str):
         self.name = name
         self.position = position
@@ -56,13 +85,31 @@ class ChipCell():
 
 
 class Chip():
-    def __init__(self, width, height, inputs, outputs):
+    def __init__(self, width, height, inputs, outputs, tech: Technology | None = None):
         self.width = width
         self.height = height
+
+        # Routing layers, bottom up, and the layers input and output pins block. Without a technology the
+        # chip has a single layer.
+        self.layers: list[Layer] = tech.layers if tech != None else [Layer("M1")]
+        self.pin_layers: list[int] = tech.pin_layers if tech != None else [0]
         self.cells: list[ChipCell] = []
 
-        # -1 is an unroutable obstacle (aka pin)
-        self.obstacles = [[0] * width for _ in range(height)]
+        # Indexes over cells: by id, and by the BIN_SIZE bins of the chip their boxes cover
+        self.cells_by_id: dict[str, ChipCell] = {}
+        self.bins: dict[tuple[int, int], list[ChipCell]] = {}
+
+        # Indexed [layer, x, y]. -1 is an unroutable obstacle (aka pin), -2 is a committed route. The routes are
+        # drawn from self.routes, which holds each net's geometry.
+        self.obstacles = np.zeros((len(self.layers), width, height), dtype=np.int8)
+        self.routes = routes.Routes()
+
+        # Global routing: the routing tracks through each GCell and the nets crossing it, indexed [column, row],
+        # and the GCells each net's detailed route is confined to
+        gcells = (-(-width // GCELL_SIZE), -(-height // GCELL_SIZE))
+        self.gcell_capacity = np.zeros(gcells, dtype=np.float64)
+        self.gcell_demand = np.zeros(gcells, dtype=np.int32)
+        self.corridors: dict[str, list[tuple[int, int]]] = {}
 
         self.pin_x0 = PIN_SIZE[0] * 0.5
         self.pin_y0 = PIN_SIZE[1] * 0.5
@@ -72,8 +119,17 @@ class Chip():
 
         self.dropped_routes = 0
 
+        # Number of cells the router expanded for each net, keyed by "source->sink"
+        self.expansions: dict[str, int] = {}
+
+        # Pins are PIN_SIZE apart along the bottom edge.
+        pins = len(inputs) + len(outputs)
+        if self.pin_x0 + PIN_SIZE[0] * (2 * pins - 1) > width:
+            raise ValueError(
+                f"No room for {pins} pins along a chip {width} wide")
+
         for pin in inputs:
-            self.cells.append(ChipCell(
+            self.add_cell(ChipCell(
                 pin,
                 Position(self.pin_x0,
                          self.pin_y0,
@@ -82,14 +138,13 @@ class Chip():
                 "pin",
                 "Input_" + pin))
 
-            for i in range(int(self.pin_x0), int(self.pin_x0 + PIN_SIZE[0])):
-                for j in range(int(self.pin_y0), int(self.pin_y0 + PIN_SIZE[1])):
-                    self.obstacles[i][j] = -1
+            self.obstacles[self.pin_layers, int(self.pin_x0):int(self.pin_x0 + PIN_SIZE[0]),
+                           int(self.pin_y0):int(self.pin_y0 + PIN_SIZE[1])] = -1
 
             self.pin_x0 += PIN_SIZE[0] * 2
 
         for pin in outputs:
-            self.cells.append(ChipCell(
+            self.add_cell(ChipCell(
                 pin,
                 Position(self.pin_x0,
                          self.pin_y0,
@@ -98,39 +153,145 @@ class Chip():
                 "pin",
                 "Output_" + pin))
 
-            for i in range(int(self.pin_x0), int(self.pin_x0 + PIN_SIZE[0])):
-                for j in range(int(self.pin_y0), int(self.pin_y0 + PIN_SIZE[1])):
-                    self.obstacles[i][j] = -1
+            self.obstacles[self.pin_layers, int(self.pin_x0):int(self.pin_x0 + PIN_SIZE[0]),
+                           int(self.pin_y0):int(self.pin_y0 + PIN_SIZE[1])] = -1
 
             self.pin_x0 += PIN_SIZE[0] * 2
 
-    # add_stdcell(tree) recursively adds all the standard cells from tree into tree
-    def add_tree(self, tree: EDANode, tech: Technology):
-        if tree.behavior.name == "Input":
-            return
-
-        if self.cell_x0 + STDCELL_SIZE[1] > self.width:
-            self.cell_x0 = PIN_SIZE[0]
-            self.cell_y0 = self.cell_y0 + STDCELL_SIZE[1]
-
-        self.cells.append(ChipCell(
-            tree.behavior.name,
-            Position(self.cell_x0, self.cell_y0, self.cell_x0 +
-                     STDCELL_SIZE[0], self.cell_y0 + STDCELL_SIZE[1]),
-            "stdcell",
-            tree.uuid.hex
-        ))
-
-        std_cell = [cell for cell in tech.cells if cell.name ==
-                    tree.behavior.name][0]
-
-        for pin in std_cell.pins:
-            self.obstacles[self.cell_x0 + pin.x][self.cell_y0 + pin.y] = -1
-
-        self.cell_x0 += STDCELL_SIZE[1]
-
-        for child in tree.children:
-            self.add_tree(child, tech)
+    # sites() returns the origin of the grid of sites standard cells are placed on, and its columns and rows.
+    def sites(self) -> tuple[tuple[int, int], int, int]:
+        origin = (PIN_SIZE[0], PIN_SIZE[1] * 2)
+        return (origin, (self.width - origin[0]) // STDCELL_SIZE[0], (self.height - origin[1]) // STDCELL_SIZE[1])
+
+    # add_trees(trees, tech) fills the sites row by row with the standard cells of trees, in postorder, without
+    # recursion. Nodes shared by several trees or parents (when trees are DAGs) are only placed once. It raises
+    # ValueError, before placing anything, if there aren't enough sites for every cell.
+    def add_trees(self, trees: list[EDANode], tech: Technology):
+        nodes: dict = {}
+        for tree in trees:
+            for node in tree.postorder():
+                if node.behavior.name != "Input" and not node.uuid.hex in self.cells_by_id:
+                    nodes.setdefault(node.uuid, node)
+
+        (_, columns, rows) = self.sites()
+        count = len(nodes) + \
+            sum(1 for cell in self.cells if cell.type == "stdcell")
+        if count > columns * rows:
+            raise ValueError(
+                f"Only {columns * rows} sites on a {self.width}x{self.height} chip for {count} standard cells")
+
+        for node in nodes.values():
+            if self.cell_x0 + STDCELL_SIZE[0] > self.width:
+                self.cell_x0 = PIN_SIZE[0]
+                self.cell_y0 = self.cell_y0 + STDCELL_SIZE[1]
+
+            self.add_cell(ChipCell(
+                node.behavior.name,
+                Position(self.cell_x0, self.cell_y0, self.cell_x0 +
+                         STDCELL_SIZE[0], self.cell_y0 + STDCELL_SIZE[1]),
+                "stdcell",
+                node.uuid.hex
+            ))
+
+            for pin in tech.cell(node.behavior.name).pins:
+                self.obstacles[pin.layers, self.cell_x0 +
+                               pin.x, self.cell_y0 + pin.y] = -1
+
+            self.cell_x0 += STDCELL_SIZE[0]
+
+    # add_cell(cell) adds cell to the chip and its indexes.
+    def add_cell(self, cell: ChipCell):
+        self.cells.append(cell)
+        self.cells_by_id[cell.id] = cell
+        for key in __bins__(cell.position):
+            self.bins.setdefault(key, []).append(cell)
+
+    # move_cell(cell, position) moves cell to position, keeping the bin index up to date.
+    def move_cell(self, cell: ChipCell, position: Position):
+        for key in __bins__(cell.position):
+            self.bins[key].remove(cell)
+        cell.position = position
+        for key in __bins__(cell.position):
+            self.bins.setdefault(key, []).append(cell)
+
+    # overlapping(position) returns the cells whose boxes overlap the box position.
+    def overlapping(self, position: Position) -> list[ChipCell]:
+        found = {}
+        for key in __bins__(position):
+            for cell in self.bins.get(key, []):
+                if cell.position.x0 < position.x1 and position.x0 < cell.position.x1 and \
+                        cell.position.y0 < position.y1 and position.y0 < cell.position.y1:
+                    found[cell.id] = cell
+        return list(found.values())
+
+    # place(cones, tech, effort, seed) moves the standard cells placed by add_trees to minimize the half-perimeter
+    # wirelength of the nets between them, by simulated annealing over the cell sites. effort trades
+    # runtime for quality, and 0 keeps the row-fill placement. It returns the HPWL before and after.
+    def place(self, cones: dict[str, EDANode], tech: Technology, effort: float = 1.0, seed: int = 0) -> tuple[int, int]:
+        stdcells = [cell for cell in self.cells if cell.type == "stdcell"]
+        index = {cell.id: i for (i, cell) in enumerate(stdcells)}
+        fixed = {cell.id: (int(cell.position.x0), int(cell.position.y1 - 1))
+                 for cell in self.cells if cell.type == "pin"}
+
+        def driver(node: EDANode) -> tuple[str, tuple[int, int, int]]:
+            if node.behavior.name == "Input":
+                return ("Input_" + node.children[0], (-1, *fixed["Input_" + node.children[0]]))
+            output_pin = tech.cell(node.behavior.name).output_pin
+            return (node.uuid.hex, (index[node.uuid.hex], output_pin.x, output_pin.y))
+
+        # Every driver's net connects its output pin to the input pins it feeds.
+        nets: dict[str, list[tuple[int, int, int]]] = {}
+        visited = set()
+        for (output, tree) in cones.items():
+            (name, pin) = driver(tree)
+            nets.setdefault(name, [pin]).append(
+                (-1, *fixed["Output_" + output]))
+
+            for node in tree.postorder():
+                if node.behavior.name == "Input" or node.uuid in visited:
+                    continue
+                visited.add(node.uuid)
+
+                pins = tech.cell(node.behavior.name).pins
+                for (i, child) in enumerate(node.children):
+                    (name, pin) = driver(child)
+                    nets.setdefault(name, [pin]).append(
+                        (index[node.uuid.hex], pins[i].x, pins[i].y))
+
+        # add_trees checked there's a site for every cell.
+        (origin, columns, rows) = self.sites()
+        initial = [int((cell.position.y0 - origin[1]) // STDCELL_SIZE[1] * columns +
+                       (cell.position.x0 - origin[0]) // STDCELL_SIZE[0]) for cell in stdcells]
+        annealer = placer.Annealer(columns, rows, origin, STDCELL_SIZE, list(
+            nets.values()), initial, seed=seed)
+        before = annealer.cost
+
+        annealer.anneal(effort)
+
+        for (cell, site) in zip(stdcells, annealer.site_of):
+            (x0, y0) = (annealer.site_x(site), annealer.site_y(site))
+            self.move_cell(cell, Position(
+                x0, y0, x0 + STDCELL_SIZE[0], y0 + STDCELL_SIZE[1]))
+
+        for cell in stdcells:
+            if len(self.overlapping(cell.position)) > 1:
+                logging.warning(f"Cell {cell.id} overlaps another cell")
+
+        self.__mark_obstacles__(tech)
+        logging.info(f"Placement HPWL {before} -> {annealer.cost}")
+        return (before, annealer.cost)
+
+    # __mark_obstacles__(tech) rebuilds the obstacle map from the pins of the placed cells.
+    def __mark_obstacles__(self, tech: Technology):
+        self.obstacles[:, :, :] = 0
+        for cell in self.cells:
+            (x0, y0) = (int(cell.position.x0), int(cell.position.y0))
+            if cell.type == "pin":
+                self.obstacles[self.pin_layers, x0:x0 +
+                               PIN_SIZE[0], y0:y0 + PIN_SIZE[1]] = -1
+            else:
+                for pin in tech.cell(cell.name).pins:
+                    self.obstacles[pin.layers, x0 + pin.x, y0 + pin.y] = -1
 
     def __plot_rectangle__(self, ax: Axes, x0: float, y0: float, x1: float, y1: float, color: str, text: str | None = None):
         verts = [(x0, y0),
@@ -162,109 +323,636 @@ class Chip():
             case "chip": return "white"
             case _: raise Exception("Unknown cell type", type)
 
-    def dump_image(self, path):
-        fig, ax = plt.subplots()
+    # dump_image(path, layer, window) draws the chip to path, with the routes on every layer in their layer's color and
+    # vias in black, or only the routes on layer if it's given. window (x0, y0, x1, y1), with x1 and y1 exclusive,
+    # draws only that part of the chip. The grid is drawn as one image, downsampled when the window is more than
+    # MAX_IMAGE_CELLS cells on a side, with only the cells drawn as shapes, so drawing costs O(width * height).
+    def dump_image(self, path, layer: int | None = None, window: tuple[int, int, int, int] | None = None):
+        (x0, y0, x1, y1) = window if window != None else (
+            0, 0, self.width, self.height)
+        scale = -(-max(x1 - x0, y1 - y0) // MAX_IMAGE_CELLS)
 
-        border_width = 0.0625
+        fig = Figure()
+        ax = fig.subplots()
 
-        ax.set_xlim(self.width * -border_width,
-                    self.width * (1 + border_width))
-        ax.set_ylim(self.height * -border_width,
-                    self.height * (1 + border_width))
-
-        self.__plot_rectangle__(ax, 0, 0, self.width, self.height, "white")
-
-        for box in self.cells:
-            self.__plot_rectangle__(ax, box.position.x0, box.position.y0,
-                                    box.position.x1, box.position.y1, self.__type_to_color__(box.type), box.name)
-
-        for x in range(len(self.obstacles)):
-            for y in range(len(self.obstacles[0])):
-                if self.obstacles[x][y] == -1:
-                    self.__plot_rectangle__(ax, x, y, x+1, y+1, "orange", "")
-                elif self.obstacles[x][y] == -2:
-                    self.__plot_rectangle__(ax, x, y, x+1, y+1, "blue", "")
-
-        plt.savefig(path)
-
-    def route(self, tree: EDANode, tech: Technology, route_to: None | tuple[int, int] = None):
-        if route_to == None:
-            output_cell = [
-                cell for cell in self.cells if cell.id.startswith("Output_")][0]
-
-            self.route(
-                tree,
-                tech,
-                route_to=(int(output_cell.position.x0),
-                          int(output_cell.position.y1 - 1)))
-
-            logging.info(
-                f"Routing complete. Dropped {self.dropped_routes} routes."
-            )
-            return
-
-        obs_map = copy.deepcopy(self.obstacles)
-
-        std_cell = None
-        pos_data = None
-        (start_x, start_y) = (-1, -1)
-        if tree.behavior.name != "Input":
-            std_cell = [cell for cell in tech.cells if cell.name ==
-                        tree.behavior.name][0]
-
-            pos_data = [c for c in self.cells if c.id ==
-                        tree.uuid.hex][0].position
-
-            (start_x, start_y) = (int(pos_data.x0 + std_cell.output_pin.x),
-                                  int(pos_data.y0 + std_cell.output_pin.y))
-        else:
-            position = [
-                c for c in self.cells if c.id == "Input_" + tree.children[0]
-            ][0].position
-            (start_x, start_y) = (int(position.x0), int(position.y1 - 1))
-
-        obs_map[start_x][start_y] = 1
-
-        iteration = 0
-        routing_failed = False
+        border_width = 0.0625
 
-        # ripple out
-        while not routing_failed and obs_map[route_to[0]][route_to[1]] < 1:
-            iteration += 1
-            if iteration > self.height * self.width:
-                # We have literally tried ev erything
+        ax.set_xlim(x0 - (x1 - x0) * border_width,
+                    x1 + (x1 - x0) * border_width)
+        ax.set_ylim(y0 - (y1 - y0) * border_width,
+                    y1 + (y1 - y0) * border_width)
+
+        self.__plot_rectangle__(ax, x0, y0, x1, y1, "white")
+        # Cells straddling the window are cut off at its edge.
+        clip = patches.Rectangle(
+            (x0, y0), x1 - x0, y1 - y0, transform=ax.transData)
+
+        cells = self.overlapping(Position(x0, y0, x1, y1)) \
+            if window != None else self.cells
+        boxes = ax.add_collection(PatchCollection([patches.Rectangle((cell.position.x0, cell.position.y0),
+                                                             cell.position.x1 - cell.position.x0, cell.position.y1 - cell.position.y0)
+                                           for cell in cells],
+                                          facecolors=[self.__type_to_color__(cell.type) for cell in cells], edgecolors="black"))
+        boxes.set_clip_path(clip)
+        # Labels and vias are too small to read once the image is downsampled.
+        if scale == 1:
+            for cell in cells:
+                if x0 <= cell.position.x0 < x1 and y0 <= cell.position.y0 < y1:
+                    ax.text(cell.position.x0, cell.position.y0, cell.name, ha='left',
+                            va='bottom', size=12, zorder=4)
+
+        image = self.__raster__(layer, (x0, y0, x1, y1), scale)
+        ax.imshow(image.transpose(1, 0, 2), origin="lower", interpolation="nearest", zorder=2,
+                  extent=(x0, x0 + image.shape[0] * scale, y0, y0 + image.shape[1] * scale))
+
+        if layer == None and scale == 1:
+            ax.add_collection(PatchCollection([patches.Circle((x + 0.5, y + 0.5), 0.3) for (_, x, y) in self.routes.vias()
+                                               if x0 <= x < x1 and y0 <= y < y1], facecolors="black", zorder=3))
+
+        fig.savefig(path)
+
+    # dump_tiles(path, layer, size) draws the chip in tiles of size by size cells, at full resolution, to files named
+    # after path with the tile's lower left corner added ("chip.png" becomes "chip-0-0.png" and so on). It returns the
+    # files written.
+    def dump_tiles(self, path: str, layer: int | None = None, size: int = MAX_IMAGE_CELLS) -> list[str]:
+        (stem, extension) = os.path.splitext(path)
+        files = []
+        for x in range(0, self.width, size):
+            for y in range(0, self.height, size):
+                file = f"{stem}-{x}-{y}{extension}"
+                self.dump_image(file, layer, (x, y, min(x + size, self.width), min(y + size, self.height)))
+                files.append(file)
+        return files
+
+    # __raster__(layer, window, scale) returns the RGBA image, indexed [x, y], of the pins and routes (only those on
+    # layer, if it's given) in window, each pixel covering scale by scale cells. A pixel covering a route shows the
+    # route on the highest layer, otherwise one covering a pin shows the pin.
+    def __raster__(self, layer: int | None, window: tuple[int, int, int, int], scale: int) -> np.ndarray:
+        (x0, y0, x1, y1) = window
+        grid = self.obstacles[:, x0:x1, y0:y1]
+
+        # 0 is empty, 1 is a pin and 2 + i is a route on layer i.
+        classes = (grid == -1).any(axis=0).astype(np.int16)
+        for i in range(len(self.layers)):
+            if layer == None or i == layer:
+                classes[grid[i] == -2] = 2 + i
+
+        if scale > 1:
+            (width, height) = classes.shape
+            classes = np.pad(classes, ((0, -width % scale), (0, -height % scale)))
+            classes = classes.reshape(
+                classes.shape[0] // scale, scale, classes.shape[1] // scale, scale).max(axis=(1, 3))
+
+        colors = np.array([(0, 0, 0, 0), to_rgba("orange")] +
+                          [to_rgba(LAYER_COLORS[i % len(LAYER_COLORS)]) for i in range(len(self.layers))])
+        return colors[classes]
+
+    # route(cones, tech, mode, jobs) routes every output cone in cones, a map from output name to mapped tree, to its
+    # output pin, with PathFinder negotiated congestion. Every net is routed ignoring the others except for a cost on
+    # the cells they use, then nets on overused cells are ripped up and rerouted, with the cost of sharing a cell
+    # growing each iteration and the cost of historically congested cells growing with their overuse, until no cell
+    # is used by two nets. Each iteration routes nets in batches whose bounding boxes don't overlap, over a process
+    # pool when jobs > 1. Routes left overused after MAX_ITERATIONS are dropped.
+    # Routes run on every layer of the technology, favouring each layer's preferred direction, and change layers
+    # through vias that cost tech.via_cost.
+    def route(self, cones: dict[str, EDANode], tech: Technology, mode: str = router.DIJKSTRA, jobs: int = 1):
+        nets = self.__nets__(cones, tech)
+
+        steps = [(WRONG_WAY_COST if layer.direction == VERTICAL else 1,
+                  WRONG_WAY_COST if layer.direction == HORIZONTAL else 1) for layer in self.layers]
+
+        blocked = self.obstacles == -1
+        for (sources, _) in nets.values():
+            for source in sources:
+                blocked[source] = True
+        occupancy = np.zeros(self.obstacles.shape, dtype=np.int32)
+        history = np.zeros(self.obstacles.shape, dtype=np.float64)
+
+        # The cells each net occupies, and the paths to each of its sinks (None if they couldn't be routed).
+        cells: dict[str, set[tuple[int, int, int]]] = {
+            net: set() for net in nets}
+        paths: dict[str, dict[str, list | None]] = {net: {} for net in nets}
+
+        # Each sink's path branches off the driver's pin (None) or the path of an earlier sink.
+        parents: dict[str, dict[str, str | None]] = {net: {} for net in nets}
+
+        boxes = {net: self.__corridor_box__(net) if net in self.corridors else
+                 self.__box__([(x, y) for (_, x, y) in sources + [target for (_, targets) in sinks for target in targets]], BOX_MARGIN)
+                 for (net, (sources, sinks)) in nets.items()}
+
+        present = PRESENT_FACTOR
+        pending = list(nets)
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs) if jobs > 1 else None
+        try:
+            for iteration in range(1, MAX_ITERATIONS + 1):
+                for batch in __batches__(pending, boxes):
+                    for net in batch:
+                        for cell in cells[net]:
+                            occupancy[cell] -= 1
+                        cells[net] = set()
+
+                    # Only the costs inside each net's box are worked out, since that's all its search reads.
+                    work = [(self.__window__(__costs__(history, occupancy, blocked, present, boxes[net]), net, boxes[net]), boxes[net][:2], nets[net][0], [targets for (_, targets) in nets[net][1]], mode, steps, tech.via_cost)
+                            for net in batch]
+                    if pool != None and len(batch) > 1:
+                        results = pool.map(__route_net__, *zip(*work))
+                    else:
+                        results = map(__route_net__, *zip(*work))
+
+                    for (net, result) in zip(batch, results):
+                        (sources, sinks) = nets[net]
+                        if any(path == None for (path, _, _) in result):
+                            # Nothing inside the box (or corridor) reaches some sink, so search the whole chip.
+                            costs = __costs__(history, occupancy, blocked, present,
+                                              (0, 0, self.width, self.height))
+                            retry = __route_net__(costs, (0, 0), sources, [
+                                targets for (_, targets) in sinks], mode, steps, tech.via_cost)
+                            result = [(path, expansions + more, parent) for ((_, expansions, _), (path, more, parent))
+                                      in zip(result, retry)]
+
+                        for ((sink, _), (path, expansions, parent)) in zip(sinks, result):
+                            self.expansions[f"{net}->{sink}"] = expansions
+                            paths[net][sink] = path
+                            parents[net][sink] = sinks[parent][0] if parent != None and parent >= 0 else None
+                            if path != None:
+                                # The path runs from the sink's pin to a pin or a cell already in the net.
+                                cells[net].update(path[1:-1])
+
+                        for cell in cells[net]:
+                            occupancy[cell] += 1
+
+                overused = occupancy > 1
+                logging.debug(
+                    f"Routing iteration {iteration}: rerouted {len(pending)} nets, {np.count_nonzero(overused)} cells overused")
+                if not overused.any():
+                    break
+
+                history += HISTORY_FACTOR * (occupancy - 1).clip(min=0)
+                present *= PRESENT_GROWTH
+                pending = [net for net in nets if any(
+                    overused[cell] for cell in cells[net])]
+        finally:
+            if pool != None:
+                pool.shutdown()
+
+        logging.info(f"Negotiated congestion in {iteration} iterations")
+
+        # Drop the paths still on overused cells, and the paths branching off them, which frees those cells for
+        # the nets after them.
+        self.dropped_routes = 0
+        self.routes = routes.Routes()
+        for (net, (sources, sinks)) in nets.items():
+            dropped = {sink for (sink, _) in sinks if paths[net][sink] == None or
+                       any(occupancy[cell] > 1 for cell in paths[net][sink][1:-1])}
+            while True:
+                orphans = {sink for (sink, parent) in parents[net].items()
+                           if parent in dropped and not sink in dropped}
+                if not orphans:
+                    break
+                dropped |= orphans
+
+            dropped = [sink for (sink, _) in sinks if sink in dropped]
+            if dropped:
+                kept = set()
+                for (sink, _) in sinks:
+                    if not sink in dropped:
+                        kept.update(paths[net][sink][1:-1])
+                for cell in cells[net] - kept:
+                    occupancy[cell] -= 1
+                cells[net] = kept
+
+            for sink in dropped:
                 logging.error(
-                    "Could not route. Voiding attempt, dropping route")
-                routing_failed = True
-                self.dropped_routes += 1
-
-            for i in range(0, len(obs_map)):
-                for j in range(0, len(obs_map[0])):
-                    if obs_map[i][j] == 0 or (i, j) == (route_to[0], route_to[1]):
-                        if (i, j) == (route_to[0], route_to[1]):
-                            (x, y) = __find_min_neighbor__(obs_map, i, j)
-                        (x, y) = __find_min_neighbor__(obs_map, i, j)
-                        if x >= 0 and y >= 0 and obs_map[x][y] > 0:
-                            obs_map[i][j] = obs_map[x][y] + 1
-
-        current_x, current_y = (route_to[0], route_to[1])
-
-        # backtrack
-        while (current_x, current_y) != (start_x, start_y) and not routing_failed:
-            self.obstacles[current_x][current_y] = -2
-            (current_x, current_y) = __find_min_neighbor__(
-                obs_map, current_x, current_y)
-
-        self.obstacles[start_x][start_y] = -1
-        self.obstacles[route_to[0]][route_to[1]] = -1
-
-        if tree.behavior.name != "Input":
-            for i in range(len(tree.children)):
-                pin = (pos_data.x0 + std_cell.pins[i].x,
-                       pos_data.y0 + std_cell.pins[i].y)
-                self.route(tree.children[i], tech, route_to=pin)
+                    f"Could not route {net}->{sink}. Dropping route")
+            self.dropped_routes += len(dropped)
+
+            for (sink, _) in sinks:
+                if not sink in dropped:
+                    self.routes.add(net, paths[net][sink])
+
+        self.obstacles[self.obstacles == -2] = 0
+        self.routes.rasterize(self.obstacles, -2)
+
+        logging.info(
+            f"Routing complete. Dropped {self.dropped_routes} routes."
+        )
+        logging.info(
+            f"Router expanded {sum(self.expansions.values())} cells over {len(self.expansions)} nets."
+        )
+        logging.info(
+            f"Routes are {self.routes.wirelength()} long with {self.routes.via_count()} vias, over {len(self.routes.segments)} nets")
+        if len(self.layers) > 1:
+            logging.info(
+                "Routes use " + ", ".join(f"{np.count_nonzero(self.obstacles[i] == -2)} cells on {layer.name}" for (i, layer) in enumerate(self.layers)))
+
+    # rip_up(net) removes net's route from the chip, returning its segments. It only touches the cells on the route.
+    def rip_up(self, net: str) -> np.ndarray:
+        segments = self.routes.remove(net)
+        for row in segments:
+            for cell in routes.decode(row):
+                if self.obstacles[cell] == -2:
+                    self.obstacles[cell] = 0
+        return segments
+
+    # global_route(cones, tech, mode) routes every net of cones over the GCells, to find the corridor of GCells each net's
+    # detailed route should search and to estimate congestion before detailed routing. A GCell's capacity is the number
+    # of routing tracks through it, estimated from the cells (over every layer) that aren't pins, and every net crossing
+    # it uses one. Nets are routed as Steiner trees and negotiated like the detailed routes, until no GCell is over
+    # capacity or GLOBAL_ITERATIONS have run. It returns the number of GCells left over capacity.
+    def global_route(self, cones: dict[str, EDANode], tech: Technology, mode: str = router.DIJKSTRA) -> int:
+        nets = self.__nets__(cones, tech)
+        (columns, rows) = self.gcell_capacity.shape
+
+        free = np.zeros((columns * GCELL_SIZE, rows * GCELL_SIZE))
+        free[:self.width, :self.height] = (self.obstacles != -1).sum(axis=0)
+        self.gcell_capacity = free.reshape(
+            columns, GCELL_SIZE, rows, GCELL_SIZE).sum(axis=(1, 3)) / GCELL_SIZE
+        self.gcell_demand = np.zeros((columns, rows), dtype=np.int32)
+        history = np.zeros((columns, rows), dtype=np.float64)
+
+        def gcells(cells: list[tuple[int, int, int]]) -> list[tuple[int, int, int]]:
+            return sorted({(0, x // GCELL_SIZE, y // GCELL_SIZE) for (_, x, y) in cells})
+
+        terminals = {net: (gcells(sources), [gcells(targets) for (_, targets) in sinks])
+                     for (net, (sources, sinks)) in nets.items()}
+        trees: dict[str, set[tuple[int, int]]] = {net: set() for net in nets}
+
+        present = PRESENT_FACTOR
+        pending = list(nets)
+        for iteration in range(1, GLOBAL_ITERATIONS + 1):
+            for net in pending:
+                for gcell in trees[net]:
+                    self.gcell_demand[gcell] -= 1
+
+                costs = (1 + history) * (1 + present * (self.gcell_demand +
+                                                        1 - self.gcell_capacity).clip(min=0))
+                (sources, sinks) = terminals[net]
+                tree = {(x, y) for (_, x, y) in sources}
+                for (path, _, _) in __route_net__(costs[np.newaxis], (0, 0), sources, sinks, mode, [(1, 1)], 1):
+                    tree.update((x, y) for (_, x, y) in path)
+                trees[net] = tree
+
+                for gcell in tree:
+                    self.gcell_demand[gcell] += 1
+
+            overflow = (self.gcell_demand - self.gcell_capacity).clip(min=0)
+            logging.debug(
+                f"Global routing iteration {iteration}: rerouted {len(pending)} nets, {np.count_nonzero(overflow)} GCells over capacity")
+            if not overflow.any():
+                break
+
+            history += HISTORY_FACTOR * overflow
+            present *= PRESENT_GROWTH
+            pending = [net for net in nets if any(
+                overflow[gcell] > 0 for gcell in trees[net])]
+
+        self.corridors = {}
+        for (net, tree) in trees.items():
+            corridor = {(x + dx, y + dy) for (x, y) in tree
+                        for dx in range(-CORRIDOR_MARGIN, CORRIDOR_MARGIN + 1)
+                        for dy in range(-CORRIDOR_MARGIN, CORRIDOR_MARGIN + 1)}
+            self.corridors[net] = sorted((x, y) for (x, y) in corridor
+                                         if 0 <= x < columns and 0 <= y < rows)
+
+        overflowed = np.count_nonzero(self.gcell_demand > self.gcell_capacity)
+        usage = np.divide(self.gcell_demand, self.gcell_capacity, out=np.zeros(
+            (columns, rows)), where=self.gcell_capacity > 0)
+        logging.info(
+            f"Global routing: {overflowed} of {columns * rows} GCells over capacity, peak usage {usage.max():.0%}")
+        return overflowed
+
+    # dump_congestion(path) draws the global routing congestion map to path, each GCell colored by the fraction of its
+    # capacity the global routes use.
+    def dump_congestion(self, path: str):
+        (columns, rows) = self.gcell_capacity.shape
+        usage = np.divide(self.gcell_demand, self.gcell_capacity, out=np.full(
+            (columns, rows), np.inf), where=self.gcell_capacity > 0)
+
+        fig = Figure()
+        ax = fig.subplots()
+        image = ax.imshow(usage.T, origin="lower", cmap="inferno", vmin=0, vmax=max(1, usage[np.isfinite(usage)].max(initial=1)),
+                          extent=(0, columns * GCELL_SIZE, 0, rows * GCELL_SIZE))
+        fig.colorbar(image, ax=ax, label="demand / capacity")
+        for box in self.cells:
+            ax.add_patch(patches.Rectangle((box.position.x0, box.position.y0), box.position.x1 - box.position.x0,
+                                           box.position.y1 - box.position.y0, fill=False, edgecolor="white", linewidth=0.5))
+        ax.set_title("Global routing congestion")
+
+        fig.savefig(path)
+
+    # __corridor_box__(net) returns the box (x0, y0, x1, y1) of cells covered by net's corridor, with x1 and y1 exclusive.
+    def __corridor_box__(self, net: str) -> tuple[int, int, int, int]:
+        corridor = self.corridors[net]
+        return (min(x for (x, _) in corridor) * GCELL_SIZE,
+                min(y for (_, y) in corridor) * GCELL_SIZE,
+                min(self.width, (max(x for (x, _) in corridor) + 1) * GCELL_SIZE),
+                min(self.height, (max(y for (_, y) in corridor) + 1) * GCELL_SIZE))
+
+    # __window__(window, net, box) blocks the cells outside net's corridor (if it has one) in window, the costs of the
+    # cells in box, and returns it.
+    def __window__(self, window: np.ndarray, net: str, box: tuple[int, int, int, int]) -> np.ndarray:
+        (x0, y0, x1, y1) = box
+        if not net in self.corridors:
+            return window
+
+        inside = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+        for (x, y) in self.corridors[net]:
+            inside[x * GCELL_SIZE - x0:(x + 1) * GCELL_SIZE - x0,
+                   y * GCELL_SIZE - y0:(y + 1) * GCELL_SIZE - y0] = True
+        window[:, ~inside] = np.inf
+        return window
+
+    # __nets__(cones, tech) returns the nets to route for cones, keyed by driver: the cells of the driver's output pin,
+    # and the (sink, pin cells) of every input it feeds. A pin's cells are its position on each layer it blocks. A driver
+    # shared by several cones is one net, and its inputs are only routed once.
+    def __nets__(self, cones: dict[str, EDANode], tech: Technology) -> dict[str, tuple[list[tuple[int, int, int]], list[tuple[str, list[tuple[int, int, int]]]]]]:
+        def pin(cell: ChipCell) -> list[tuple[int, int, int]]:
+            return [(layer, int(cell.position.x0), int(cell.position.y1 - 1)) for layer in self.pin_layers]
+
+        def cell_pin(cell: ChipCell, pin) -> list[tuple[int, int, int]]:
+            return [(layer, int(cell.position.x0 + pin.x), int(cell.position.y0 + pin.y)) for layer in pin.layers]
+
+        def driver(node: EDANode) -> tuple[str, list[tuple[int, int, int]]]:
+            if node.behavior.name == "Input":
+                name = "Input_" + node.children[0]
+                return (name, pin(self.cells_by_id[name]))
+            return (node.uuid.hex, cell_pin(self.cells_by_id[node.uuid.hex], tech.cell(node.behavior.name).output_pin))
+
+        nets = {}
+        visited = set()
+        for (output, tree) in cones.items():
+            (name, sources) = driver(tree)
+            output_cell = self.cells_by_id["Output_" + output]
+            nets.setdefault(name, (sources, []))[1].append(
+                (output_cell.id, pin(output_cell)))
+
+            for node in tree.postorder():
+                if node.behavior.name == "Input" or node.uuid in visited:
+                    continue
+                visited.add(node.uuid)
+
+                cell = self.cells_by_id[node.uuid.hex]
+                pins = tech.cell(node.behavior.name).pins
+                for (i, child) in enumerate(node.children):
+                    (name, sources) = driver(child)
+                    nets.setdefault(name, (sources, []))[1].append(
+                        (f"{node.uuid.hex}.{pins[i].name}", cell_pin(cell, pins[i])))
+        return nets
+
+    # __box__(points, margin) returns the bounding box (x0, y0, x1, y1) of points grown by margin on every side,
+    # clipped to the chip, with x1 and y1 exclusive.
+    def __box__(self, points: list[tuple[int, int]], margin: int) -> tuple[int, int, int, int]:
+        return (max(0, min(x for (x, _) in points) - margin),
+                max(0, min(y for (_, y) in points) - margin),
+                min(self.width, max(x for (x, _) in points) + margin + 1),
+                min(self.height, max(y for (_, y) in points) + margin + 1))
+
+    # The cell indexes and the obstacle map are derived from the rest of the chip, so they are left out of dumps and
+    # rebuilt on load. The obstacle map is saved as the list of pin cells, and the routes drawn back over it.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["cells_by_id"]
+        del state["bins"]
+        del state["obstacles"]
+        state["shape"] = self.obstacles.shape
+        state["pins"] = np.argwhere(self.obstacles == -1).astype(np.int32)
+        return state
+
+    def __setstate__(self, state):
+        shape = state.pop("shape")
+        pins = state.pop("pins")
+        self.__dict__.update(state)
+
+        self.obstacles = np.zeros(shape, dtype=np.int8)
+        self.obstacles[tuple(pins.T)] = -1
+        self.routes.rasterize(self.obstacles, -2)
+
+        cells = self.cells
+        self.cells = []
+        self.cells_by_id = {}
+        self.bins = {}
+        for cell in cells:
+            self.add_cell(cell)
 
     def dump_json(self, file: str):
         with open(file, "w") as f:
             chip_json = jsonpickle.dumps(self)
             f.write(chip_json)
+
+    # dump_def(file) writes the chip to file in a line based format modelled on DEF, streaming it a line at a time so
+    # big chips are never held in memory as text. Files ending in .gz are gzipped. Every statement ends with " ;":
+    #
+    #   VERSION 1 ;
+    #   DIEAREA width height ;
+    #   LAYERS count ;                 then a "LAYER name direction ;" line per layer, bottom up, direction being
+    #                                  HORIZONTAL, VERTICAL or NONE
+    #   PINLAYERS layer ... ;          the layers input and output pins block
+    #   DROPPED count ;                the routes the router dropped
+    #   COMPONENTS count ;             then a "- id name type x0 y0 x1 y1 ;" line per cell, and END COMPONENTS
+    #   PINS count ;                   then a "- layer x y length ;" line per run of pin cells from (layer, x, y)
+    #                                  up y, and END PINS
+    #   NETS count ;                   then per net "- net" followed by a "+ layer0 x0 y0 layer1 x1 y1" line per
+    #                                  route segment (see routes.py) and " ;", and END NETS
+    #   END DESIGN
+    def dump_def(self, file: str):
+        with (gzip.open(file, "wt") if file.endswith(".gz") else open(file, "w")) as f:
+            f.write(f"VERSION {DEF_VERSION} ;\n")
+            f.write(f"DIEAREA {self.width} {self.height} ;\n")
+            f.write(f"LAYERS {len(self.layers)} ;\n")
+            for layer in self.layers:
+                f.write(
+                    f"LAYER {layer.name} {(layer.direction or 'none').upper()} ;\n")
+            f.write(
+                f"PINLAYERS {' '.join(str(layer) for layer in self.pin_layers)} ;\n")
+            f.write(f"DROPPED {self.dropped_routes} ;\n")
+
+            f.write(f"COMPONENTS {len(self.cells)} ;\n")
+            for cell in self.cells:
+                position = cell.position
+                f.write(
+                    f"- {cell.id} {cell.name} {cell.type} {position.x0:g} {position.y0:g} {position.x1:g} {position.y1:g} ;\n")
+            f.write("END COMPONENTS\n")
+
+            runs = routes.encode_runs(np.argwhere(self.obstacles == -1))
+            f.write(f"PINS {len(runs)} ;\n")
+            for (layer, x, y, length) in runs:
+                f.write(f"- {layer} {x} {y} {length} ;\n")
+            f.write("END PINS\n")
+
+            f.write(f"NETS {len(self.routes.segments)} ;\n")
+            for (net, rows) in self.routes.segments.items():
+                f.write(f"- {net}\n")
+                for row in rows:
+                    f.write(f"  + {' '.join(str(value) for value in row)}\n")
+                f.write("  ;\n")
+            f.write("END NETS\n")
+            f.write("END DESIGN\n")
+
+    # dump_grid(file) saves the obstacle map to file as a .npy array, which load can memory map.
+    def dump_grid(self, file: str):
+        np.save(file, self.obstacles)
+
+
+# load(file, grid) reads a chip written by Chip.dump_def. If grid is the path of an obstacle map saved by
+# Chip.dump_grid it is memory mapped (copy on write) rather than rebuilt from the pins and routes.
+def load(file: str, grid: str | None = None) -> Chip:
+    # statements(f) yields the words of each line of f, without the " ;" ending statements. A line that is only
+    # ";", ending a net, yields [";"].
+    def statements(f):
+        for line in f:
+            words = line.split()
+            if len(words) > 1 and words[-1] == ";":
+                words.pop()
+            if words:
+                yield words
+
+    with (gzip.open(file, "rt") if file.endswith(".gz") else open(file)) as f:
+        lines = statements(f)
+
+        def expect(keyword: str) -> list[str]:
+            words = next(lines, None)
+            if words == None or words[0] != keyword:
+                raise ValueError(f"Expected {keyword} in {file}, found", words)
+            return words[1:]
+
+        version = int(expect("VERSION")[0])
+        if version != DEF_VERSION:
+            raise ValueError(f"Unsupported chip format version in {file}", version)
+        (width, height) = (int(value) for value in expect("DIEAREA"))
+
+        c = Chip(width, height, [], [])
+        c.layers = []
+        for _ in range(int(expect("LAYERS")[0])):
+            (name, direction) = expect("LAYER")
+            c.layers.append(
+                Layer(name, None if direction == "NONE" else direction.lower()))
+        c.pin_layers = [int(layer) for layer in expect("PINLAYERS")]
+        c.dropped_routes = int(expect("DROPPED")[0])
+
+        for _ in range(int(expect("COMPONENTS")[0])):
+            (id, name, type, *position) = expect("-")
+            c.add_cell(ChipCell(name, Position(
+                *(__number__(value) for value in position)), type, id))
+        expect("END")
+
+        pins = [[int(value) for value in expect("-")]
+                for _ in range(int(expect("PINS")[0]))]
+        expect("END")
+
+        for _ in range(int(expect("NETS")[0])):
+            (net,) = expect("-")
+            rows = []
+            while (words := next(lines)) != [";"]:
+                if words[0] != "+":
+                    raise ValueError(f"Expected + or ; in {file}, found", words)
+                rows.append([int(value) for value in words[1:]])
+            c.routes.segments[net] = np.array(
+                rows, dtype=np.int32).reshape(-1, 6)
+        expect("END")
+
+    if grid != None:
+        c.obstacles = np.load(grid, mmap_mode="c")
+    else:
+        c.obstacles = np.zeros(
+            (len(c.layers), width, height), dtype=np.int8)
+        for (layer, x, y, length) in pins:
+            c.obstacles[layer, x, y:y + length] = -1
+        c.routes.rasterize(c.obstacles, -2)
+    return c
+
+
+# __number__(text) parses a coordinate, which is an integer unless it has a fraction.
+def __number__(text: str) -> int | float:
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+
+# __costs__(history, occupancy, blocked, present, box) returns the PathFinder cost of entering each cell in box, on
+# every layer. Capacity is one net per cell, so a cell already in use by another net is overused by the next. Every
+# net in a batch is routed over its own window at once, possibly in another process, so each gets a new array, but
+# it's worked out in place.
+def __costs__(history: np.ndarray, occupancy: np.ndarray, blocked: np.ndarray, present: float,
+              box: tuple[int, int, int, int]) -> np.ndarray:
+    (x0, y0, x1, y1) = box
+    costs = history[:, x0:x1, y0:y1] + 1
+    sharing = occupancy[:, x0:x1, y0:y1] * present
+    sharing += 1
+    costs *= sharing
+    costs[blocked[:, x0:x1, y0:y1]] = np.inf
+    return costs
+
+
+# __batches__(nets, boxes) splits nets into batches whose bounding boxes don't overlap, first fit in order, so the
+# nets in a batch can be routed at the same time without seeing each other.
+def __batches__(nets: list[str], boxes: dict[str, tuple[int, int, int, int]]) -> list[list[str]]:
+    batches: list[list[str]] = []
+    for net in nets:
+        (x0, y0, x1, y1) = boxes[net]
+        for batch in batches:
+            if all(x1 <= other[0] or other[2] <= x0 or y1 <= other[1] or other[3] <= y0
+                   for other in (boxes[member] for member in batch)):
+                batch.append(net)
+                break
+        else:
+            batches.append([net])
+    return batches
+
+
+# __route_net__(costs, origin, sources, targets, mode, steps, via_cost) routes a net from sources to each list of
+# cells in targets over costs, a window of the chip's costs whose corner is at origin, growing a rectilinear Steiner
+# tree. Sinks are connected nearest first, each by the cheapest path to any cell of the tree so far. It returns
+# (path, expansions, parent) for each list of targets: the path in chip coordinates, from the sink up to and including
+# the tree cell it branches off, and the index of the target whose path that cell is on (-1 for the sources). The path
+# and parent are None if the sink couldn't be reached.
+def __route_net__(costs: np.ndarray, origin: tuple[int, int], sources: list[tuple[int, int, int]], targets: list[list[tuple[int, int, int]]],
+                  mode: str, steps: list[tuple[float, float]], via_cost: float) -> list[tuple[list | None, int, int | None]]:
+    (x0, y0) = origin
+    (layers, width, height) = costs.shape
+
+    # Every sink searches the same costs, so they're flattened once.
+    flat = costs.ravel().tolist()
+
+    # The tree's cells, in window coordinates, and the target whose path each is on.
+    owner = {(layer, x - x0, y - y0): -1 for (layer, x, y) in sources}
+    results: list = [(None, 0, None)] * len(targets)
+
+    # The (x, y) of each sink's cells, and the Manhattan distance from each sink still to route to the tree, which
+    # only has to be lowered against the cells each new branch adds.
+    corners = [{(x - x0, y - y0) for (_, x, y) in cells} for cells in targets]
+
+    def distance(i: int, tree: set[tuple[int, int]]) -> int:
+        return min(abs(x - tx) + abs(y - ty) for (x, y) in corners[i] for (tx, ty) in tree)
+
+    tree = {(x, y) for (_, x, y) in owner}
+    remaining = {i: distance(i, tree) for i in range(len(targets))}
+    # Scratch lists for every sink's search, since they all search the same window.
+    scratch = ([float("inf")] * len(flat), [-1] * len(flat))
+    while remaining:
+        # Prim's order: the sink nearest the tree goes next.
+        nearest = min(remaining, key=remaining.__getitem__)
+        del remaining[nearest]
+
+        cells = [(layer, x - x0, y - y0) for (layer, x, y) in targets[nearest]]
+        (path, expansions) = router.cheapest_path(
+            costs, list(owner), cells, mode, steps, via_cost, flat, scratch)
+        if path == None:
+            results[nearest] = (None, expansions, None)
+            continue
+
+        # The path ends on the tree cell it grew from (which is the sink itself if the sink is on the tree already),
+        # so the step onto the tree, along a layer or through a via, was costed like any other.
+        branch = path[-1]
+        parent = owner[branch]
+
+        for cell in path[:-1]:
+            owner[cell] = nearest
+        for cell in cells:
+            owner.setdefault(cell, nearest)
+        results[nearest] = ([(layer, x + x0, y + y0)
+                            for (layer, x, y) in path], expansions, parent)
+
+        added = {(x, y) for (_, x, y) in path[:-1]} | corners[nearest]
+        for i in remaining:
+            remaining[i] = min(remaining[i], distance(i, added))
+    return results
@@ -1,8 +1,8 @@
 from enum import Enum
-from typing import Self
 from io import TextIOWrapper
-from uuid import uuid4
-import logging
+from uuid import UUID, uuid4
+from collections import deque
+import random
 
 BlockType = Enum(
     'BlockType',
@@ -25,6 +25,13 @@ class NodeBehavior:
         self.arg_count = arg_count
         self.behavior = behavior
 
+    # The built in behaviors are lambdas, which can't be pickled, so they pickle by name instead.
+    # This lets trees be sent to worker processes.
+    def __reduce__(self):
+        if BEHAVIORS.get(self.name) is self:
+            return (behavior_by_name, (self.name,))
+        return (NodeBehavior, (self.name, self.arg_count, self.behavior))
+
 
 INPUT_NAME = "Input"
 OUTPUT_NAME: str = "Output"
@@ -39,6 +46,17 @@ XOR = NodeBehavior("^", 2, lambda _, arr: arr[0] != arr[1])
 NOT = NodeBehavior("~", 1, lambda _, arr: not arr[0])
 NAND = NodeBehavior("NAND", 2, lambda _, arr: not (arr[0] and arr[1]))
 NOR = NodeBehavior("NOR", 2, lambda _, arr: not (arr[0] or arr[1]))
+# Constants, which logic rewriting folds away
+ZERO = NodeBehavior("0", 0, lambda _, arr: False)
+ONE = NodeBehavior("1", 0, lambda _, arr: True)
+
+BEHAVIORS = {b.name: b for b in [INPUT, OUTPUT,
+                                 WIRE, AND, OR, XOR, NOT, NAND, NOR, ZERO, ONE]}
+
+
+# behavior_by_name(name) returns the built in NodeBehavior called name.
+def behavior_by_name(name: str) -> NodeBehavior:
+    return BEHAVIORS[name]
 
 
 class Position:
@@ -88,85 +106,168 @@ class EDANode:
         if (len(self.children) != self.behavior.arg_count):
             raise TypeError("Incorrect child count.")
 
+    # postorder() iterates over the distinct nodes reachable from self, yielding children before their parents.
+    def postorder(self):
+        visited = set()
+        stack = [(self, False)]
+        while stack:
+            (node, expanded) = stack.pop()
+            if expanded:
+                yield node
+                continue
+
+            if node.uuid in visited:
+                continue
+            visited.add(node.uuid)
+
+            stack.append((node, True))
+            if node.behavior.name != INPUT_NAME:
+                for child in reversed(node.children):
+                    stack.append((child, False))
+
     def simulate(self, simdata):
         if self.behavior.name == INPUT_NAME:
             return simdata[self.children[0]]
         return self.behavior.behavior(simdata, [child.simulate(simdata) for child in self.children])
 
     def dump_mermaid(self, file: TextIOWrapper):
-        file.write("flowchart TD\n")
-        self.__dump_mermaid__(file, [])
-
-    def __dump_mermaid__(self, file: TextIOWrapper, visited_list: list[str]):
-        if (self.uuid.hex in visited_list):
-            return
-
-        if (self.behavior.name == "Input" or self.behavior.name == "Output"):
-            file.write(
-                f"\tnode{self.uuid.hex}[/{self.behavior.name} {self.children[0]}\\]\n")
-        else:
-            if self.behavior.name == "Input":
-                file.write(
-                    f"\tnode{self.uuid.hex}[/\"{self.behavior.name}\"\\]\n")
-            elif self.__type__ == "verilog":
-                file.write(
-                    f"\tnode{self.uuid.hex}[\"{self.behavior.name}\"]\n")
-            elif self.__type__ == "stdcell":
-                file.write(
-                    f"\tnode{self.uuid.hex}{'{{'}\"{self.behavior.name}\"{'}}'}\n")
-
-            for child in self.children:
-                child.__dump_mermaid__(file, visited_list + [self.uuid.hex])
-                file.write(f"\tnode{self.uuid.hex}-->node{child.uuid.hex}\n")
-
-    def cannonicalize(self):
-        match self.behavior.name:
-            case ("NAND" | "NOT" | "Input" | "Output"): return self
-            case "&":
-                newChild = EDANode.with_children(
-                    NAND, Position(), [c.cannonicalize() for c in self.children])
-                return EDANode.with_children(NOT, Position(), [newChild])
-            case "|":
-                a_inv = EDANode.with_children(
-                    NOT, Position(), [self.children[0].cannonicalize()])
-                b_inv = EDANode.with_children(
-                    NOT, Position(), [self.children[1].cannonicalize()])
-                return EDANode.with_children(NAND, Position(), [a_inv, b_inv])
-            case "~": return EDANode.with_children(NOT, Position, [self.children[0].cannonicalize()])
-
-    def simplify(self):
-        if self.behavior.name == "~" and self.children[0].behavior.name == "~":
-            return self.children[0].children[0].simplify()
-        else:
-            return EDANode.with_children(self.behavior,
-                                         self.position,
-                                         [c.simplify() for c in self.children] if self.behavior.name != "Input" else self.children)
+        dump_graph([self], file)
 
     def set_type(self, type: str):
         self.__type__ = type
 
-    # match(other) checks if other matches the pattern presented at the root of self. If it does, it returns the children replacement. If not, it returns None.
-    def match(self, other: Self, thing=0) -> None | list[Self]:
-        logging.debug(
-            f"Step {thing}: comparing {self.behavior.name} to {other.behavior.name}")
-        if other.behavior.name == "Input":
-            logging.debug(
-                f"Found input. Partial match.")
-            return [self]
-
-        if other.behavior.name != self.behavior.name:
-            logging.debug(
-                f"Mismatch {other.behavior.name} to {self.behavior.name}. No match.")
-            return None
-
-        logging.debug(
-            f"Match {other.behavior.name} to {self.behavior.name}.")
-
-        results: list[Self] = []
-        for i in range(len(self.children)):
-            res = self.children[i].match(other.children[i], thing=thing + 1)
-            if res == None:
-                return None
-            results += res
 
-        return results
+# Behaviors whose result doesn't depend on the order of their children.
+COMMUTATIVE = {AND.name, OR.name, XOR.name, NAND.name, NOR.name}
+
+
+# renumber(trees) replaces the random uuid of every node in trees, a map from output name to output cone, with its
+# index in postorder, so building the same design twice gives its nodes the same uuids.
+def renumber(trees: dict[str, EDANode]):
+    nodes: dict = {}
+    for tree in trees.values():
+        for node in tree.postorder():
+            nodes.setdefault(node.uuid, node)
+    for (number, node) in enumerate(nodes.values()):
+        node.uuid = UUID(int=number)
+
+
+# Formats dump_graph writes, and the extension of each.
+MERMAID = "mermaid"
+DOT = "dot"
+EDGES = "edges"
+GRAPH_EXTENSIONS = {MERMAID: ".mmd", DOT: ".dot", EDGES: ".edges"}
+
+# dump_graph buffers this many lines between writes.
+GRAPH_BUFFER_LINES = 4096
+
+
+# dump_graph(trees, file, format, depth, cones, max_nodes, seed) writes trees, a list of trees or a map from output
+# name to output cone, as one graph in format:
+#
+#   mermaid  a mermaid flowchart
+#   dot      a GraphViz digraph
+#   edges    a line "v id kind label" per node, kind being output, input, verilog or stdcell, then a line
+#            "e parent child" per edge
+#
+# Nodes are numbered in the order they're written. Shared nodes are written once, as is each input. To keep diagrams
+# of big designs readable, depth limits how far below the outputs the graph goes, cones limits the number of output
+# cones (picking that many at random, with seed, when there are more) and max_nodes limits the number of nodes.
+# Nodes whose children were left out are labelled "...". The graph is walked breadth first without recursion, so
+# it never hits the recursion limit, and written in buffered blocks.
+def dump_graph(trees: list[EDANode] | dict[str, EDANode], file: TextIOWrapper, format: str = MERMAID,
+               depth: int | None = None, cones: int | None = None, max_nodes: int | None = None, seed: int = 0):
+    if not format in GRAPH_EXTENSIONS:
+        raise ValueError("Unknown graph format", format)
+
+    roots = list(trees.items()) if isinstance(trees, dict) \
+        else [(None, tree) for tree in trees]
+    if cones != None and len(roots) > cones:
+        roots = [roots[i] for i in sorted(
+            random.Random(seed).sample(range(len(roots)), cones))]
+
+    lines = []
+
+    def write(line: str):
+        lines.append(line)
+        if len(lines) >= GRAPH_BUFFER_LINES:
+            file.write("".join(lines))
+            lines.clear()
+
+    # Every input is one node, keyed by its name, and every other node is keyed by its uuid.
+    ids: dict = {}
+    queue: deque[tuple[EDANode, int]] = deque()
+
+    # visit(node, level) returns node's id, numbering and queueing it the first time it's seen, or None if it's new
+    # and the graph is full.
+    def visit(node: EDANode, level: int) -> int | None:
+        key = node.children[0] if node.behavior.name == INPUT_NAME else node.uuid
+        if not key in ids:
+            if max_nodes != None and len(ids) >= max_nodes:
+                return None
+            ids[key] = len(ids)
+            queue.append((node, level))
+        return ids[key]
+
+    write({MERMAID: "flowchart TD\n", DOT: "digraph design {\n", EDGES: ""}[format])
+
+    for (i, (output, tree)) in enumerate(roots):
+        root = visit(tree, 0)
+        if output != None:
+            write(__graph_node__(format, f"o{i}", "output", output))
+            if root != None:
+                write(__graph_edge__(format, f"o{i}", root))
+
+    while queue:
+        (node, level) = queue.popleft()
+        edges = []
+        truncated = False
+        if node.behavior.name != INPUT_NAME:
+            if depth != None and level >= depth:
+                truncated = len(node.children) > 0
+            else:
+                for child in node.children:
+                    child_id = visit(child, level + 1)
+                    if child_id == None:
+                        truncated = True
+                    else:
+                        edges.append(child_id)
+
+        (kind, label) = ("input", node.children[0]) if node.behavior.name == INPUT_NAME \
+            else (node.__type__, node.behavior.name)
+        write(__graph_node__(format, ids[node.children[0] if kind == "input" else node.uuid], kind,
+                             label + (" ..." if truncated else "")))
+        for child_id in edges:
+            write(__graph_edge__(
+                format, ids[node.uuid], child_id))
+
+    if format == DOT:
+        write("}\n")
+    file.write("".join(lines))
+
+
+# __graph_node__(format, id, kind, label) returns the line declaring a node in format. Numbered nodes are called n<id>.
+def __graph_node__(format: str, id: int | str, kind: str, label: str) -> str:
+    name = id if isinstance(id, str) else f"n{id}"
+    match format:
+        case "mermaid":
+            match kind:
+                case "output": return f"\t{name}[\\Output {label}/]\n"
+                case "input": return f"\t{name}[/Input {label}\\]\n"
+                case "stdcell": return f"\t{name}{{{{\"{label}\"}}}}\n"
+                case _: return f"\t{name}[\"{label}\"]\n"
+        case "dot":
+            shape = {"output": "invtrapezium", "input": "trapezium",
+                     "stdcell": "hexagon"}.get(kind, "box")
+            return f"\t{name} [label=\"{label}\", shape={shape}];\n"
+        case _:
+            return f"v {name} {kind} {label.replace(' ', '_')}\n"
+
+
+# __graph_edge__(format, parent, child) returns the line for an edge from parent to child in format.
+def __graph_edge__(format: str, parent: int | str, child: int) -> str:
+    parent = parent if isinstance(parent, str) else f"n{parent}"
+    match format:
+        case "mermaid": return f"\t{parent}-->n{child}\n"
+        case "dot": return f"\t{parent} -> n{child};\n"
+        case _: return f"e {parent} n{child}\n"
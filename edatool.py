@@ -1,9 +1,19 @@
 import lexparse
 import argparse
+import artifacts
+import functools
 import technology
 import logging
 import chip
+import router
+import eda_tree
+import netlist
+import rewrite
+import simulator
+import checkpoint
 import os
+import sys
+import time
 
 step = 1
 
@@ -18,92 +28,370 @@ def log_step(name):
     step += 1
 
 
+# count_nodes(trees) returns the number of distinct nodes across trees.
+def count_nodes(trees: dict[str, eda_tree.EDANode]) -> int:
+    return len({node.uuid for tree in trees.values() for node in tree.postorder()})
+
+
+# verify(stage, reference, trees, inputs, jobs, tech) checks that trees compute the same function as the
+# reference program, exiting with the first counterexample if they don't.
+def verify(stage: str, reference: simulator.Program, trees: dict[str, eda_tree.EDANode], inputs: list[str], jobs: int, tech: technology.Technology | None = None):
+    start = time.perf_counter()
+
+    missing = [output for (output, tree) in trees.items() if tree == None]
+    if missing:
+        logging.error(f"Verification failed: {stage} produced no logic for {', '.join(missing)}")
+        sys.exit(1)
+
+    candidate = simulator.compile_program(trees, tech, inputs=inputs)
+    counterexample = simulator.find_counterexample(
+        reference, candidate, jobs=jobs)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    if counterexample != None:
+        (output, simdata) = counterexample
+        vector = ", ".join(
+            f"{name}={int(value)}" for (name, value) in simdata.items())
+        logging.error(
+            f"Verification failed: {stage} changes {output} when {vector} ({elapsed:.1f} ms)")
+        sys.exit(1)
+
+    logging.info(f"Verified {stage} in {elapsed:.1f} ms")
+
+
+# log_rewrite(before, after, eliminated) logs the result of rewriting the netlist before into after, and the nodes
+# each rule eliminated (or added, if it added more than it removed).
+def log_rewrite(before: netlist.Netlist, after: netlist.Netlist, eliminated: dict[str, int]):
+    logging.info(f"Success! {len(before)} nodes rewritten to {len(after)}" + "".join(
+        f", {rule} {'eliminated' if count > 0 else 'added'} {abs(count)}" for (rule, count) in eliminated.items() if count != 0))
+
+
+# dump_graph(trees, file, **limits) writes a graph of every output cone in trees, in the format and within the
+# limits eda_tree.dump_graph takes.
+def dump_graph(trees: dict[str, eda_tree.EDANode], file: str, **limits):
+    with open(file, "w") as f:
+        eda_tree.dump_graph(trees, f, **limits)
+
+
+# frozen(trees) returns trees, a map from output name to a cone of EDANodes or to a view of a netlist, in a form
+# later stages can't change, to write in the background. Netlists aren't changed once built, so views are returned
+# as they are, and EDANodes are copied into a netlist, which unlike a deep copy doesn't recurse down the cones.
+def frozen(trees: dict) -> dict[str, netlist.NodeView]:
+    if all(isinstance(tree, netlist.NodeView) for tree in trees.values()):
+        return trees
+    return netlist.from_trees(trees).roots()
+
+
+# options holds every option that applies to a single design, so other entry points (batch.py) can share them.
+options = argparse.ArgumentParser(add_help=False)
+options.add_argument('-m', '--mermaid', action="store_true",
+                     help="Whether to dump mermaid files for each step for debugging or presentation.")
+options.add_argument('--graph-format', choices=list(eda_tree.GRAPH_EXTENSIONS), default=eda_tree.MERMAID,
+                     help="Format to dump each step's netlist in with -m: a mermaid flowchart, a GraphViz digraph or an edge list.")
+options.add_argument('--graph-depth', type=int,
+                     help="How far below the outputs the netlists dumped with -m go.")
+options.add_argument('--graph-cones', type=int,
+                     help="How many output cones, sampled at random, the netlists dumped with -m show.")
+options.add_argument('--graph-nodes', type=int,
+                     help="Most nodes in each netlist dumped with -m.")
+options.add_argument('-v', '--verbose', action="store_true",
+                     help="Whether to include verbose information.")
+
+options.add_argument('-s', '--share', action="store_true",
+                     help="Whether to structurally hash the design into a DAG so identical subexpressions are shared.")
+options.add_argument('--netlist', action="store_true",
+                     help="Whether to map the design as the compact array-backed netlist it's rewritten in, rather than as a tree.")
+options.add_argument('-a', '--astar', action="store_true",
+                     help="Whether to route with A* search instead of Dijkstra's algorithm.")
+
+options.add_argument('--verify', action="store_true",
+                     help="Whether to check that every step preserves the function of the design, by simulation.")
+options.add_argument('-j', '--jobs', type=int,
+                     help="Number of processes to map independent output cones, verify and route with.", default=1)
+
+options.add_argument('-e', '--effort', type=float,
+                     help="Placement effort, trading runtime for wirelength. 0 keeps the row-fill placement.", default=1.0)
+
+options.add_argument('--cache-dir', default=technology.DEFAULT_CACHE_DIR,
+                     help="Directory to cache compiled standard cell libraries and stage checkpoints in.")
+options.add_argument('--cache-size', type=float, default=1024,
+                     help="Size in MB past which the least recently used checkpoints are evicted.")
+options.add_argument('--cache-age', type=float, default=30,
+                     help="Age in days past which checkpoints are evicted.")
+options.add_argument('--no-cache', action="store_true",
+                     help="Whether to run every stage from scratch without reading or writing the cache.")
+
+options.add_argument('--congestion', metavar="FILE",
+                     help="Where to draw the global routing congestion map, to size the chip before detailed routing.")
+options.add_argument('--global-only', action="store_true",
+                     help="Whether to stop after global routing, skipping detailed routing.")
+
+options.add_argument('-o', '--output', default=".",
+                     help="Directory to write the chip and the mermaid/ directory to.")
+options.add_argument('-f', '--format', choices=["json", "def", "def.gz"], default="json",
+                     help="Format to write the chip in: chip.json, or the streamed DEF-like chip.def, gzipped or not.")
+options.add_argument('--grid', action="store_true",
+                     help="Whether to also write the obstacle map to chip-grid.npy, which chip.load can memory map.")
+
+options.add_argument('-w', '--width', type=int,
+                     help="Width of the chip.", default=40)
+options.add_argument('-l', '--height', type=int,
+                     help="Height of the chip.", default=40)
+
+
 parser = argparse.ArgumentParser(
     prog="edatool.py",
     description="edatool.py is a simple EDA tool for generating standard-cell based designs implemented in Python.",
-    epilog="(c) 2023 William Barkoff")
+    epilog="(c) 2023 William Barkoff",
+    parents=[options])
 
 parser.add_argument('filename', help="The verilog file to produce a chip for.")
 parser.add_argument(
     'standard_cells', help="The JSON standard cell description file.")
-parser.add_argument('-m', '--mermaid', action="store_true",
-                    help="Whether to dump mermaid files for each step for debugging or presentation.")
-parser.add_argument('-v', '--verbose', action="store_true",
-                    help="Whether to include verbose information.")
-
-parser.add_argument('-w', '--width', type=int,
-                    help="Width of the chip.", default=40)
-parser.add_argument('-l', '--height', type=int,
-                    help="Height of the chip.", default=40)
-
-args = parser.parse_args()
-
-logging.basicConfig(format='%(message)s',
-                    level=logging.DEBUG if args.verbose else logging.INFO)
-
-logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
-
-if args.mermaid:
-    if not os.path.exists("mermaid"):
-        os.makedirs("mermaid")
-
-# First, we parse the standard cell library
-log_step("Parsing standard cell library")
-
-tech = technology.Technology(
-    args.standard_cells, dump_stdcell_mermaid=args.mermaid)
-logging.info(f"Success!")
-
-log_step("Parsing the verilog input")
-
-verilog_ast = lexparse.lexparse(args.filename)[0]
-logging.info(f"Success!")
-if args.mermaid:
-    file = f"mermaid/{verilog_ast.name}-ast.mmd"
-    logging.info(f"Writing file {file}")
-    verilog_ast.eda_tree.dump_mermaid(open(file, "w"))
-
-log_step("Cannonicalizing design")
-
-cannonicalized = verilog_ast.eda_tree.cannonicalize()
-logging.info(f"Success!")
-if args.mermaid:
-    file = f"mermaid/{verilog_ast.name}-cannonicalized.mmd"
-    logging.info(f"Writing file {file}")
-    cannonicalized.dump_mermaid(open(file, "w"))
-
-log_step("Simplifying logic")
-
-simplified = cannonicalized.simplify()
-logging.info(f"Success!")
-if args.mermaid:
-    file = f"mermaid/{verilog_ast.name}-simplified.mmd"
-    logging.info(f"Writing file {file}")
-    simplified.dump_mermaid(open(file, "w"))
-
-log_step("Mapping technology")
-(mapped, price) = tech.map(simplified)
-logging.info(f"Success! Mapping price is {price}")
-if args.mermaid:
-    file = f"mermaid/{verilog_ast.name}-mapped.mmd"
-    logging.info(f"Writing file {file}")
-    mapped.dump_mermaid(open(file, "w"))
-
-log_step("Placing standard cells")
-
-c = chip.Chip(args.width, args.height, verilog_ast.inputs, verilog_ast.outputs)
-c.add_tree(mapped, tech)
-if args.mermaid:
-    file = f"mermaid/chip-placement.png"
-    logging.info(f"Writing file {file}")
-    c.dump_image(file)
-
-log_step("Routing chip")
-c.route(mapped, tech)
-if args.mermaid:
-    file = f"mermaid/chip-routed.png"
-    logging.info(f"Writing file {file}")
-    c.dump_image(file)
-
-logging.info(f"Writing file chip.jso")
-c.dump_json("chip.json")
+
+
+def main():
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s',
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+
+    logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)
+
+    checkpoints = open_checkpoints(args)
+    run(args, checkpoints=checkpoints)
+    if checkpoints != None:
+        checkpoints.evict()
+
+
+# open_checkpoints(args) returns the checkpoint store args ask for, or None if caching is off or the cache directory
+# can't be used.
+def open_checkpoints(args) -> checkpoint.Checkpoints | None:
+    if args.no_cache:
+        return None
+    try:
+        return checkpoint.Checkpoints(
+            args.cache_dir, int(args.cache_size * (1 << 20)), args.cache_age * 24 * 60 * 60)
+    except OSError as e:
+        logging.warning(f"Running without checkpoints: {e}")
+        return None
+
+
+# run(args, tech, checkpoints) produces the chip for one design, writing chip.json or chip.def (and the
+# grid and mermaid files, if asked for) to args.output. tech is the loaded standard cell library, or None to load it
+# from args.standard_cells when a stage first needs it. It returns the routed chip.
+def run(args, tech: technology.Technology | None = None, checkpoints: checkpoint.Checkpoints | None = None) -> chip.Chip:
+    global step
+    step = 1
+
+    os.makedirs(args.output, exist_ok=True)
+    mermaid = os.path.join(args.output, "mermaid")
+    if args.mermaid:
+        os.makedirs(mermaid, exist_ok=True)
+    graph = functools.partial(dump_graph, format=args.graph_format, depth=args.graph_depth,
+                              cones=args.graph_cones, max_nodes=args.graph_nodes)
+    extension = eda_tree.GRAPH_EXTENSIONS[args.graph_format]
+
+    # Each stage's checkpoint is keyed on the key of the stage before it and the options the stage
+    # depends on, so changing an option only reruns the stages from the first one that uses it.
+    # Dumping mermaid files and verifying happen as stages run, so they're part of every key, along with
+    # the directory the mermaid files go to.
+    keys = {}
+    keys["parse"] = checkpoint.key(
+        "parse", checkpoint.file_hash(args.filename), args.mermaid, args.verify,
+        (os.path.abspath(mermaid), args.graph_format, args.graph_depth, args.graph_cones, args.graph_nodes)
+        if args.mermaid else None)
+    keys["cannonicalize"] = checkpoint.key(
+        "cannonicalize", keys["parse"], args.share)
+    keys["simplify"] = checkpoint.key("simplify", keys["cannonicalize"])
+    keys["map"] = checkpoint.key(
+        "map", keys["simplify"], technology.library_hash(args.standard_cells), args.netlist)
+    keys["place"] = checkpoint.key(
+        "place", keys["map"], args.width, args.height, args.effort)
+    keys["global"] = checkpoint.key("global", keys["place"], args.astar)
+    keys["route"] = checkpoint.key("route", keys["global"])
+
+    values = {}
+    hits = {}
+
+    # stage(name, compute) returns the output of a stage, from its checkpoint if there is one and
+    # otherwise by running compute (which asks for the outputs of the stages it needs).
+    def stage(name, compute):
+        if name in values:
+            return values[name]
+
+        if checkpoints != None:
+            (hit, value) = checkpoints.get(keys[name])
+            if hit:
+                hits[name] = True
+                values[name] = value
+                return value
+
+        hits[name] = False
+        values[name] = compute()
+        if checkpoints != None:
+            checkpoints.put(keys[name], values[name])
+        return values[name]
+
+    def library() -> technology.Technology:
+        nonlocal tech
+        if tech == None:
+            log_step("Parsing standard cell library")
+            tech = technology.load(
+                args.standard_cells,
+                cache_dir=None if args.no_cache else args.cache_dir,
+                stdcell_mermaid_dir=mermaid if args.mermaid else None)
+            logging.info(f"Success!")
+        return tech
+
+    reference = None
+
+    def check(name, trees, tech=None):
+        nonlocal reference
+        verilog_ast = stage("parse", parse)
+        if reference == None:
+            reference = simulator.compile_program(
+                verilog_ast.trees, inputs=verilog_ast.inputs)
+        verify(name, reference, trees, verilog_ast.inputs, args.jobs, tech)
+
+    def parse():
+        log_step("Parsing the verilog input")
+
+        verilog_ast = next(lexparse.modules(args.filename))
+        logging.info(f"Success! Found {len(verilog_ast.trees)} output cones")
+        if args.mermaid:
+            writer.submit(f"{mermaid}/{verilog_ast.name}-ast{extension}",
+                          graph, frozen(verilog_ast.trees), snapshot=False)
+        return verilog_ast
+
+    def cannonicalize():
+        verilog_ast = stage("parse", parse)
+
+        log_step("Building netlist" +
+                 (" with shared subexpressions" if args.share else ""))
+
+        design = netlist.from_trees(verilog_ast.trees, share=args.share)
+        logging.info(
+            f"Success! {count_nodes(verilog_ast.trees)} nodes stored as {len(design)}")
+        if args.verify:
+            check("building the netlist", design.roots())
+
+        log_step("Cannonicalizing design")
+
+        (cannonical, eliminated) = rewrite.rewrite(
+            design, rewrite.CANNONICALIZE)
+        log_rewrite(design, cannonical, eliminated)
+        cannonicalized = cannonical.roots()
+        if args.verify:
+            check("cannonicalization", cannonicalized)
+        if args.mermaid:
+            writer.submit(f"{mermaid}/{verilog_ast.name}-cannonicalized{extension}",
+                          graph, frozen(cannonicalized), snapshot=False)
+        return cannonicalized
+
+    def simplify():
+        verilog_ast = stage("parse", parse)
+        cannonicalized = netlist.of(stage("cannonicalize", cannonicalize))
+
+        log_step("Simplifying logic")
+
+        (simple, eliminated) = rewrite.rewrite(cannonicalized)
+        log_rewrite(cannonicalized, simple, eliminated)
+        simplified = simple.roots()
+        if args.verify:
+            check("simplification", simplified)
+        if args.mermaid:
+            writer.submit(f"{mermaid}/{verilog_ast.name}-simplified{extension}",
+                          graph, frozen(simplified), snapshot=False)
+        return simplified
+
+    def map_technology():
+        simplified = stage("simplify", simplify)
+        tech = library()
+
+        log_step("Mapping technology")
+        if args.netlist:
+            (mapped, price) = netlist.of(simplified).map(tech)
+            mapped = mapped.to_trees()
+        else:
+            (mapped, price) = tech.map_cones(
+                netlist.of(simplified).to_trees(), jobs=args.jobs)
+        # Placed and routed chips name cells by uuid, so a mapping rerun after its checkpoint was evicted has to
+        # give the cells the ids the later checkpoints already use.
+        eda_tree.renumber(mapped)
+        logging.info(f"Success! Mapping price is {price}")
+        if args.verify:
+            check("technology mapping", mapped, tech)
+        if args.mermaid:
+            writer.submit(f"{mermaid}/{stage('parse', parse).name}-mapped{extension}",
+                          graph, frozen(mapped), snapshot=False)
+        return mapped
+
+    def place():
+        verilog_ast = stage("parse", parse)
+        mapped = stage("map", map_technology)
+        tech = library()
+
+        log_step("Placing standard cells")
+
+        c = chip.Chip(args.width, args.height,
+                      verilog_ast.inputs, verilog_ast.outputs, tech)
+        c.add_trees(list(mapped.values()), tech)
+        c.place(mapped, tech, effort=args.effort)
+        if args.mermaid:
+            writer.submit(f"{mermaid}/chip-placement.png",
+                          chip.Chip.dump_image, c)
+        return c
+
+    def global_route():
+        c = stage("place", place)
+        mapped = stage("map", map_technology)
+        tech = library()
+
+        log_step("Global routing")
+        c.global_route(mapped, tech, mode=router.ASTAR if args.astar else router.DIJKSTRA)
+        return c
+
+    def route():
+        c = stage("global", global_route)
+        mapped = stage("map", map_technology)
+        tech = library()
+
+        log_step("Routing chip")
+        c.route(mapped, tech, mode=router.ASTAR if args.astar else router.DIJKSTRA,
+                jobs=args.jobs)
+        # The routed chip isn't changed again, so it needn't be copied.
+        if args.mermaid:
+            writer.submit(f"{mermaid}/chip-routed.png",
+                          chip.Chip.dump_image, c, snapshot=False)
+            if len(c.layers) > 1:
+                for (i, layer) in enumerate(c.layers):
+                    writer.submit(f"{mermaid}/chip-routed-{layer.name}.png",
+                                  functools.partial(chip.Chip.dump_image, layer=i), c, snapshot=False)
+        return c
+
+    # Artifacts are written in the background while later stages run, and all of them are written (or the first
+    # error writing one raised) before run returns.
+    with artifacts.Writer() as writer:
+        if args.congestion:
+            c = stage("global", global_route)
+            writer.submit(args.congestion, chip.Chip.dump_congestion, c)
+
+        c = stage("global" if args.global_only else "route",
+                  global_route if args.global_only else route)
+
+        # The finished chip isn't changed again, so it needn't be copied.
+        writer.submit(os.path.join(args.output, f"chip.{args.format}"),
+                      chip.Chip.dump_json if args.format == "json" else chip.Chip.dump_def, c, snapshot=False)
+        if args.grid:
+            writer.submit(os.path.join(args.output, "chip-grid.npy"),
+                          chip.Chip.dump_grid, c, snapshot=False)
+
+    if checkpoints != None:
+        logging.info("Checkpoints: " + ", ".join(
+            f"{name} {'hit' if hits[name] else 'miss'}" for name in keys if name in hits))
+    return c
+
+
+if __name__ == "__main__":
+    main()
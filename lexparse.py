@@ -1,133 +1,200 @@
-import sys
+import re
 import eda_tree
-import pyparsing as pp
 import logging
+from typing import Iterator, TextIO
 
-ppt = pp.testing
 
-
-# A VerilogModule reporesents a module implemented in verilog
+# A VerilogModule reporesents a module implemented in verilog. trees maps each assigned output
+# to the tree driving it (its output cone), and eda_tree is the tree of the last assign.
 class VerilogModule:
-    def __init__(self, inputs: list[str], outputs: list[str], name: str, eda_tree: eda_tree.EDANode):
+    def __init__(self, inputs: list[str], outputs: list[str], name: str, trees: dict[str, eda_tree.EDANode]):
         self.name = name
-        self.eda_tree = eda_tree
+        self.trees = trees
+        self.eda_tree = list(trees.values())[-1] if trees else None
         self.inputs = inputs
         self.outputs = outputs
 
 
-# lexparse(file) lexes and parses a file. It returns an array of VerilogModules that represent the modules defined in that file.
-def lexparse(file) -> list[VerilogModule]:
-    module_name = pp.Word(pp.alphanums)("module_name")
-    module_keyword = pp.Keyword("module")
-    endmodule_keyword = pp.Keyword("endmodule")
-    semi = ";"
-
-    varname = pp.Word(pp.alphanums+"_")
-    vartype = pp.Keyword("wire") | pp.Keyword("logic")
-
-    input_stmt = "input" + varname
-    output_stmt = "output" + vartype + varname
-
-    module_decl = pp.Group(module_keyword + module_name("name") +
-                           "(" + pp.delimited_list(pp.Group(input_stmt("input") | output_stmt("output")), ",")("params") + ")" + semi)
-    endmoudle_decl = endmodule_keyword
-
-    andop, orop, notop, xorop = map(
-        lambda x: pp.Group(pp.Literal(x)("operator")), "&|~^")
-    lpar, rpar = map(pp.Suppress, "()")
-
-    stmt = pp.Forward()
-
-    valexpr = pp.infix_notation(
-        pp.Group(varname("value")),
-        [
-            (notop, 1, pp.OpAssoc.RIGHT),
-            (andop, 2, pp.OpAssoc.LEFT),
-            (xorop, 2, pp.OpAssoc.LEFT),
-            (orop, 2, pp.OpAssoc.LEFT),
-        ]
-    )
+# Tokens are identifiers, single character operators and punctuation, and (so they can be reported)
+# any other non-whitespace character. Tokens never span lines.
+TOKEN = re.compile(r"[A-Za-z0-9_]+|\S")
+IDENTIFIER = re.compile(r"[A-Za-z0-9_]+")
 
-    assign_stmt = "assign" + varname("varname") + "=" + valexpr("expr") + ";"
+VARTYPES = {"wire", "logic"}
 
-    stmt <<= assign_stmt("assign_stmt")
+# Binding power of the binary operators. ~ binds tighter than all of them, and they're all left associative.
+BINARY_OPERATORS = {
+    "&": (3, eda_tree.AND),
+    "^": (2, eda_tree.XOR),
+    "|": (1, eda_tree.OR),
+}
 
-    module_body = pp.Group(stmt)[...]("assigns")
 
-    module = module_decl("module_decl") + \
-        module_body("module_body") + endmoudle_decl
-
-    grammar = pp.Group(module)[...]("modules")
-
-    parse_results = grammar.parse_file(file)
-
-    results: list[VerilogModule] = []
-
-    for module in parse_results.modules:
-        name = module.module_decl.name
+# lexparse(file) lexes and parses a file. It returns an array of VerilogModules that represent the modules defined in that file.
+def lexparse(file: str | TextIO) -> list[VerilogModule]:
+    return list(modules(file))
+
+
+# modules(file) lexes and parses a file (a path or an open file) as a stream, yielding each module as soon as its endmodule is read.
+def modules(file: str | TextIO) -> Iterator[VerilogModule]:
+    if isinstance(file, str):
+        with open(file) as f:
+            yield from Parser(f).modules()
+    else:
+        yield from Parser(file).modules()
+
+
+# tokenize(file) yields the tokens of file as (text, line, column), reading it a line at a time.
+def tokenize(file: TextIO) -> Iterator[tuple[str, int, int]]:
+    for (line_number, line) in enumerate(file, start=1):
+        for match in TOKEN.finditer(line):
+            yield (match.group(), line_number, match.start() + 1)
+
+
+# A Parser is a recursive descent parser for modules, with a shunting-yard parser for expressions.
+# It accepts modules made of input and output declarations and assign statements over &, ^, | and ~.
+class Parser:
+    def __init__(self, file: TextIO):
+        self.filename = getattr(file, "name", "<verilog>")
+        self.tokens = tokenize(file)
+        self.token: tuple[str, int, int] | None = None
+        self.advance()
+
+    # advance() moves to the next token, returning the current one.
+    def advance(self) -> tuple[str, int, int] | None:
+        token = self.token
+        self.token = next(self.tokens, None)
+        return token
+
+    def peek(self) -> str | None:
+        return self.token[0] if self.token != None else None
+
+    def error(self, message: str):
+        if self.token == None:
+            raise SyntaxError(f"{message}, found end of file", (self.filename, None, None, None))
+        (text, line, column) = self.token
+        raise SyntaxError(f"{message}, found \"{text}\"", (self.filename, line, column, None))
+
+    # expect(text) consumes the current token, which must be text.
+    def expect(self, text: str):
+        if self.peek() != text:
+            self.error(f"Expected \"{text}\"")
+        self.advance()
+
+    # identifier() consumes the current token, which must be an identifier, and returns it.
+    def identifier(self) -> str:
+        if self.token == None or not IDENTIFIER.fullmatch(self.token[0]):
+            self.error("Expected an identifier")
+        return self.advance()[0]
+
+    def modules(self) -> Iterator[VerilogModule]:
+        while self.token != None:
+            yield self.module()
+
+    def module(self) -> VerilogModule:
+        self.expect("module")
+        name = self.identifier()
         logging.debug(f"Parsing module {name}")
+
         inputs = []
         outputs = []
-        for param in module.module_decl.params:
-            match param:
-                case ['input', n]: inputs += n
-                case ['output', t, n]: outputs += n
-                case _: raise TypeError("Invalid parameter", param)
-
-        tree: eda_tree.EDANode
-        for assign_stmt in module.module_body:
-            if (not (assign_stmt.varname in outputs)):
-                raise NotImplemented("Not implemented: assign to non-output")
-
-            expr = assign_stmt.expr
-            tree = parse_operator(expr, inputs)
-
-        results.append(VerilogModule(inputs, outputs, name, tree))
-
-    return results
-
-
-# infix_to_prefix converts parser output in infix notation to parser output in prefix notation.
-def infix_to_prefix(infix: list) -> list:
-    if ("Operator" in infix[0]):
-        return infix
-    return [infix[1], infix[0], infix[2]]
-
-
-# get_block_for_operator(operator) returns the cooresponding NodeBehavior for a verilog operator.
-def get_block_for_operator(operator: str) -> eda_tree.NodeBehavior:
-    match operator:
-        case "&": return eda_tree.AND
-        case "|": return eda_tree.OR
-        case "^": return eda_tree.XOR
-        case "~": return eda_tree.NOT
-        case _: raise TypeError("Invalid operator", operator)
-
-# parse_operator(op, inputs) returns an EDANode for a given operator and its inputs.
-
-
-def parse_operator(op, inputs) -> eda_tree.EDANode:
-    if (type(op) is str):
-        tree = eda_tree.EDANode(eda_tree.INPUT, eda_tree.UNSPECIFIED_POS)
-        tree.add_child(op)
-        return tree
-
-    if (len(op) == 1):
-        if not (op.value in inputs):
+        self.expect("(")
+        while True:
+            if self.peek() == "input":
+                self.advance()
+                inputs.append(self.identifier())
+            elif self.peek() == "output":
+                self.advance()
+                if not self.peek() in VARTYPES:
+                    self.error("Expected wire or logic")
+                self.advance()
+                outputs.append(self.identifier())
+            else:
+                self.error("Expected input or output")
+
+            if self.peek() != ",":
+                break
+            self.advance()
+        self.expect(")")
+        self.expect(";")
+
+        trees: dict[str, eda_tree.EDANode] = {}
+        while self.peek() == "assign":
+            self.advance()
+            varname = self.identifier()
+            if (not (varname in outputs)):
+                raise NotImplementedError(
+                    "Not implemented: assign to non-output", varname)
+            self.expect("=")
+            trees[varname] = self.expression(inputs)
+            self.expect(";")
+
+        self.expect("endmodule")
+        return VerilogModule(inputs, outputs, name, trees)
+
+    # expression(inputs) parses an expression with the shunting-yard algorithm. Operands and the operators still
+    # waiting for theirs are kept on explicit stacks rather than the call stack, so however deeply parentheses and ~
+    # nest, parsing never recurses.
+    def expression(self, inputs: list[str]) -> eda_tree.EDANode:
+        operands: list[eda_tree.EDANode] = []
+        # Pending "~", "(" and binary operators, and the number of "(" among them.
+        operators: list[str] = []
+        depth = 0
+
+        def reduce():
+            operator = operators.pop()
+            if operator == "~":
+                tree = eda_tree.EDANode(eda_tree.NOT, eda_tree.UNSPECIFIED_POS)
+                tree.add_child(operands.pop())
+            else:
+                right = operands.pop()
+                tree = eda_tree.EDANode(
+                    BINARY_OPERATORS[operator][1], eda_tree.UNSPECIFIED_POS)
+                tree.add_child(operands.pop())
+                tree.add_child(right)
+            operands.append(tree)
+
+        while True:
+            # An operand is any number of ~ and ( in front of an input.
+            while self.peek() == "~" or self.peek() == "(":
+                operator = self.advance()[0]
+                operators.append(operator)
+                if operator == "(":
+                    depth += 1
+            operands.append(self.operand(inputs))
+
+            while True:
+                # ~ binds tighter than any binary operator, so it applies as soon as its operand is complete.
+                while operators and operators[-1] == "~":
+                    reduce()
+                if self.peek() != ")" or depth == 0:
+                    break
+                self.advance()
+                while operators[-1] != "(":
+                    reduce()
+                operators.pop()
+                depth -= 1
+
+            if not self.peek() in BINARY_OPERATORS:
+                break
+            # Every operator is left associative, so pending ones binding at least as tightly apply first.
+            (power, _) = BINARY_OPERATORS[self.peek()]
+            while operators and operators[-1] in BINARY_OPERATORS and BINARY_OPERATORS[operators[-1]][0] >= power:
+                reduce()
+            operators.append(self.advance()[0])
+
+        while operators:
+            if operators[-1] == "(":
+                self.error("Expected \")\"")
+            reduce()
+        return operands[0]
+
+    # operand(inputs) parses the name of an input.
+    def operand(self, inputs: list[str]) -> eda_tree.EDANode:
+        name = self.identifier()
+        if not (name in inputs):
             raise TypeError("Assign statement funciton of",
-                            op.value, "which isn't an input.")
+                            name, "which isn't an input.")
         tree = eda_tree.EDANode(eda_tree.INPUT, eda_tree.UNSPECIFIED_POS)
-        tree.add_child(op.value)
+        tree.add_child(name)
         return tree
-
-    if (op[0].operator):
-        block = get_block_for_operator(op[0].operator)
-        tree = eda_tree.EDANode(block, eda_tree.UNSPECIFIED_POS)
-        tree.add_child(parse_operator(op[1], inputs))
-        return tree
-
-    block = get_block_for_operator(op[1].operator)
-    tree = eda_tree.EDANode(block, eda_tree.UNSPECIFIED_POS)
-    tree.add_child(parse_operator(op[0], inputs))
-    tree.add_child(parse_operator(op[2], inputs))
-    return tree
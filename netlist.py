@@ -0,0 +1,228 @@
+import array
+import eda_tree
+import simulator
+from eda_tree import EDANode, NodeBehavior
+from technology import Technology
+
+
+# A Netlist is a compact alternative to a design made of EDANodes. Nodes are integer ids, numbered so every node's
+# fan-ins come before it, and are stored in parallel arrays: codes[id] is the node's kind, an index into kinds of its
+# (behavior, type) (type being "verilog" or "stdcell", as in EDANode.__type__), and its fan-ins are
+# fanins[offsets[id]:offsets[id + 1]]. Fan-ins are sorted by behavior name as EDANode sorts its children, so patterns
+# match the same way. Every input is one node, named in names. With share, structurally identical nodes are merged
+# as they're added, so the design becomes a DAG.
+#
+# NodeViews let code written for EDANodes (postorder, Technology.cover, simulator.compile_program, dump_graph) run on
+# a netlist directly.
+class Netlist:
+    def __init__(self, share: bool = False):
+        self.share = share
+        self.kinds: list[tuple[NodeBehavior, str]] = []
+        self.kind_codes: dict[tuple[str, str], int] = {}
+        self.codes = array.array("H")
+        self.offsets = array.array("q", [0])
+        self.fanins = array.array("q")
+        self.names: dict[int, str] = {}
+        self.inputs: dict[str, int] = {}
+        self.outputs: dict[str, int] = {}
+        # Nodes by (code, fan-ins), when sharing
+        self.nodes: dict[tuple, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    # code(behavior, type) returns the kind code of behavior as a node of type.
+    def code(self, behavior: NodeBehavior, type: str = "verilog") -> int:
+        key = (behavior.name, type)
+        if not key in self.kind_codes:
+            self.kind_codes[key] = len(self.kinds)
+            self.kinds.append((behavior, type))
+        return self.kind_codes[key]
+
+    # input(name) returns the input node called name.
+    def input(self, name: str) -> int:
+        if not name in self.inputs:
+            id = self.__append__(self.code(eda_tree.INPUT), [])
+            self.inputs[name] = id
+            self.names[id] = name
+        return self.inputs[name]
+
+    # add(behavior, fanins, type) returns a node computing behavior over the nodes fanins.
+    def add(self, behavior: NodeBehavior, fanins: list[int], type: str = "verilog") -> int:
+        if len(fanins) != 1:
+            fanins = sorted(fanins, key=lambda fanin: self.behavior(fanin).name)
+        code = self.code(behavior, type)
+        if not self.share:
+            return self.__append__(code, fanins)
+
+        key = (code, tuple(sorted(fanins) if behavior.name in eda_tree.COMMUTATIVE else fanins))
+        if not key in self.nodes:
+            self.nodes[key] = self.__append__(code, fanins)
+        return self.nodes[key]
+
+    def __append__(self, code: int, fanins: list[int]) -> int:
+        self.codes.append(code)
+        self.fanins.extend(fanins)
+        self.offsets.append(len(self.fanins))
+        return len(self.codes) - 1
+
+    def behavior(self, id: int) -> NodeBehavior:
+        return self.kinds[self.codes[id]][0]
+
+    def type(self, id: int) -> str:
+        return self.kinds[self.codes[id]][1]
+
+    def children(self, id: int) -> array.array:
+        return self.fanins[self.offsets[id]:self.offsets[id + 1]]
+
+    def view(self, id: int) -> "NodeView":
+        return NodeView(self, id)
+
+    # roots() returns a view of the node driving each output.
+    def roots(self) -> dict[str, "NodeView"]:
+        return {output: NodeView(self, id) for (output, id) in self.outputs.items()}
+
+    # postorder(ids) returns the nodes reachable from ids, or from the outputs if ids is None, fan-ins first.
+    def postorder(self, ids: list[int] | None = None) -> list[int]:
+        reachable = bytearray(len(self.codes))
+        for id in (self.outputs.values() if ids == None else ids):
+            reachable[id] = 1
+        for id in range(len(self.codes) - 1, -1, -1):
+            if reachable[id]:
+                for fanin in self.fanins[self.offsets[id]:self.offsets[id + 1]]:
+                    reachable[fanin] = 1
+        return [id for id in range(len(self.codes)) if reachable[id]]
+
+    # trim() returns the netlist with only the nodes reachable from the outputs.
+    def trim(self) -> "Netlist":
+        reachable = self.postorder()
+        if len(reachable) == len(self.codes):
+            return self
+
+        new = Netlist(self.share)
+        renumbered = {}
+        for id in reachable:
+            if id in self.names:
+                renumbered[id] = new.input(self.names[id])
+            else:
+                (behavior, type) = self.kinds[self.codes[id]]
+                renumbered[id] = new.add(
+                    behavior, [renumbered[fanin] for fanin in self.children(id)], type)
+        new.outputs = {output: renumbered[id]
+                       for (output, id) in self.outputs.items()}
+        return new
+
+    # map(tech) covers the netlist with tech's standard cells, like Technology.map_cones, returning the mapped
+    # netlist and its price.
+    def map(self, tech: Technology) -> tuple["Netlist", int]:
+        roots = self.roots()
+        best = tech.cover(list(roots.values()))
+
+        new = Netlist(self.share)
+        mapped: dict[int, int] = {}
+        price = 0
+        for id in self.outputs.values():
+            assert (best[id] != None)
+
+            stack = [(id, False)]
+            while stack:
+                (id, expanded) = stack.pop()
+                if id in mapped:
+                    continue
+
+                (_, order, leaves) = best[id]
+                if order == None:
+                    mapped[id] = new.input(self.names[id])
+                elif expanded:
+                    cell = tech.cells[order]
+                    mapped[id] = new.add(
+                        cell.behavior, [mapped[leaf] for leaf in leaves], "stdcell")
+                    price += cell.price
+                else:
+                    stack.append((id, True))
+                    for leaf in leaves:
+                        stack.append((leaf, False))
+
+        new.outputs = {output: mapped[id]
+                       for (output, id) in self.outputs.items()}
+        return (new, price)
+
+    # program(tech, inputs) compiles the netlist for simulation, like simulator.compile_program.
+    def program(self, tech: Technology | None = None, inputs: list[str] | None = None) -> simulator.Program:
+        return simulator.compile_program(self.roots(), tech, inputs)
+
+    # simulate(simdata, tech) evaluates every output for one vector, where simdata maps each input to a bool.
+    def simulate(self, simdata: dict[str, bool], tech: Technology | None = None) -> dict[str, bool]:
+        return self.program(tech).evaluate(simdata)
+
+    # to_trees() returns an EDANode for every output, sharing the nodes the outputs share.
+    def to_trees(self) -> dict[str, EDANode]:
+        nodes: dict[int, EDANode] = {}
+        for id in self.postorder():
+            if id in self.names:
+                nodes[id] = EDANode(eda_tree.INPUT, eda_tree.UNSPECIFIED_POS)
+                nodes[id].add_child(self.names[id])
+            else:
+                (behavior, type) = self.kinds[self.codes[id]]
+                nodes[id] = EDANode.with_children(
+                    behavior, eda_tree.Position(), [nodes[fanin] for fanin in self.children(id)])
+                nodes[id].set_type(type)
+        return {output: nodes[id] for (output, id) in self.outputs.items()}
+
+
+# from_trees(trees, share) returns the netlist of trees, a map from output name to output cone.
+def from_trees(trees: dict[str, EDANode], share: bool = False) -> Netlist:
+    netlist = Netlist(share)
+    ids: dict = {}
+    for (output, tree) in trees.items():
+        for node in tree.postorder():
+            if node.uuid in ids:
+                continue
+            if node.behavior.name == eda_tree.INPUT_NAME:
+                ids[node.uuid] = netlist.input(node.children[0])
+            else:
+                ids[node.uuid] = netlist.add(
+                    node.behavior, [ids[child.uuid] for child in node.children], node.__type__)
+        netlist.outputs[output] = ids[tree.uuid]
+    return netlist
+
+
+# of(roots) returns the netlist of roots, views of every output of a netlist as returned by Netlist.roots.
+def of(roots: dict[str, "NodeView"]) -> Netlist:
+    netlist = next(iter(roots.values())).netlist
+    if {output: view.id for (output, view) in roots.items()} != netlist.outputs:
+        raise ValueError("Not the outputs of one netlist", list(roots))
+    return netlist
+
+
+# A NodeView is a node of a Netlist that looks like an EDANode. Its uuid is its id, and views are made as they're
+# asked for, so they're cheap and hold no state of their own.
+class NodeView:
+    __slots__ = ("netlist", "id")
+
+    def __init__(self, netlist: Netlist, id: int):
+        self.netlist = netlist
+        self.id = id
+
+    @property
+    def uuid(self) -> int:
+        return self.id
+
+    @property
+    def behavior(self) -> NodeBehavior:
+        return self.netlist.behavior(self.id)
+
+    @property
+    def __type__(self) -> str:
+        return self.netlist.type(self.id)
+
+    # children is the name of an input, as for an EDANode, and otherwise the views of the node's fan-ins.
+    @property
+    def children(self) -> list:
+        if self.id in self.netlist.names:
+            return [self.netlist.names[self.id]]
+        return [NodeView(self.netlist, fanin) for fanin in self.netlist.children(self.id)]
+
+    def postorder(self):
+        for id in self.netlist.postorder([self.id]):
+            yield NodeView(self.netlist, id)
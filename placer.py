@@ -0,0 +1,153 @@
+import logging
+import math
+import random
+
+# Moves tried at each temperature are EFFORT_MOVES * effort * cells^(4/3), as in VPR.
+EFFORT_MOVES = 4
+
+# Below this temperature no move that adds wirelength is accepted in practice, so annealing stops.
+MIN_TEMPERATURE = 0.01
+
+
+# An Annealer places cells on a grid of equally sized sites to minimize the half-perimeter
+# wirelength (HPWL) of the nets between them, using simulated annealing.
+#
+# Sites are numbered row by row, site s being at column s % columns and row s // columns, which
+# is site_x(s), site_y(s) on the chip. A net is a list of pins (cell, x, y). Pins on cells (cell
+# >= 0) are offset by (x, y) from their cell's site, and fixed pins (cell == -1) are at (x, y).
+class Annealer:
+    def __init__(self, columns: int, rows: int, origin: tuple[int, int], pitch: tuple[int, int], nets: list[list[tuple[int, int, int]]], initial: list[int], seed: int = 0):
+        self.columns = columns
+        self.rows = rows
+        self.origin = origin
+        self.pitch = pitch
+        self.nets = nets
+        self.random = random.Random(seed)
+
+        self.site_of = list(initial)
+        self.occupant = [-1] * (columns * rows)
+        for (cell, site) in enumerate(self.site_of):
+            self.occupant[site] = cell
+
+        self.cell_nets: list[list[int]] = [[] for _ in self.site_of]
+        for (n, net) in enumerate(nets):
+            for cell in {pin[0] for pin in net if pin[0] >= 0}:
+                self.cell_nets[cell].append(n)
+
+        self.net_cost = [self.net_hpwl(n) for n in range(len(nets))]
+        self.cost = sum(self.net_cost)
+
+    def site_x(self, site: int) -> int:
+        return self.origin[0] + (site % self.columns) * self.pitch[0]
+
+    def site_y(self, site: int) -> int:
+        return self.origin[1] + (site // self.columns) * self.pitch[1]
+
+    # net_hpwl(n) returns the half-perimeter of the bounding box of net n.
+    def net_hpwl(self, n: int) -> int:
+        xs = []
+        ys = []
+        for (cell, x, y) in self.nets[n]:
+            if cell >= 0:
+                site = self.site_of[cell]
+                x += self.site_x(site)
+                y += self.site_y(site)
+            xs.append(x)
+            ys.append(y)
+        return max(xs) - min(xs) + max(ys) - min(ys)
+
+    # __swap__(cell, site) moves cell to site, moving the cell already there (if any) to cell's old site.
+    # It returns the change in wirelength, only recosting the nets on the two cells.
+    def __swap__(self, cell: int, site: int) -> int:
+        other = self.occupant[site]
+        old_site = self.site_of[cell]
+
+        self.site_of[cell] = site
+        self.occupant[site] = cell
+        self.occupant[old_site] = other
+        if other >= 0:
+            self.site_of[other] = old_site
+
+        affected = self.cell_nets[cell] if other < 0 else \
+            set(self.cell_nets[cell]).union(self.cell_nets[other])
+
+        delta = 0
+        for n in affected:
+            cost = self.net_hpwl(n)
+            delta += cost - self.net_cost[n]
+            self.net_cost[n] = cost
+        self.cost += delta
+        return delta
+
+    # __propose__(window) picks a random cell and a random site within window rows and columns of it.
+    def __propose__(self, window: int) -> tuple[int, int]:
+        cell = self.random.randrange(len(self.site_of))
+        site = self.site_of[cell]
+        column = min(self.columns - 1, max(0, site % self.columns +
+                     self.random.randint(-window, window)))
+        row = min(self.rows - 1, max(0, site // self.columns +
+                  self.random.randint(-window, window)))
+        return (cell, row * self.columns + column)
+
+    # anneal(effort) improves the placement. effort scales the number of moves tried at each
+    # temperature, trading runtime for quality.
+    def anneal(self, effort: float = 1.0):
+        cell_count = len(self.site_of)
+        if cell_count < 2 or effort <= 0 or not self.nets:
+            return
+
+        moves = max(1, int(EFFORT_MOVES * effort * cell_count ** (4 / 3)))
+        window = max(self.columns, self.rows)
+
+        best_cost = self.cost
+        best = list(self.site_of)
+
+        # Start hot enough that almost any move is accepted, from the spread of random move costs.
+        deltas = []
+        for _ in range(cell_count):
+            (cell, site) = self.__propose__(window)
+            deltas.append(self.__swap__(cell, site))
+        mean = sum(deltas) / len(deltas)
+        temperature = 20 * \
+            math.sqrt(sum((d - mean) ** 2 for d in deltas) / len(deltas))
+
+        while temperature > max(0.005 * self.cost / len(self.nets), MIN_TEMPERATURE):
+            accepted = 0
+            for _ in range(moves):
+                (cell, site) = self.__propose__(window)
+                old_site = self.site_of[cell]
+                if site == old_site:
+                    continue
+
+                delta = self.__swap__(cell, site)
+                if delta <= 0 or self.random.random() < math.exp(-delta / temperature):
+                    accepted += 1
+                else:
+                    self.__swap__(cell, old_site)
+
+            if self.cost < best_cost:
+                best_cost = self.cost
+                best = list(self.site_of)
+
+            rate = accepted / moves
+            if rate > 0.96:
+                temperature *= 0.5
+            elif rate > 0.8:
+                temperature *= 0.9
+            elif rate > 0.15:
+                temperature *= 0.95
+            else:
+                temperature *= 0.8
+            window = min(max(self.columns, self.rows),
+                         max(1, int(window * (0.56 + rate))))
+
+            logging.debug(
+                f"Annealing at temperature {temperature:.3f}: HPWL {self.cost}, accepted {rate:.2%}, window {window}")
+
+        if best_cost < self.cost:
+            self.site_of = best
+            self.occupant = [-1] * (self.columns * self.rows)
+            for (cell, site) in enumerate(self.site_of):
+                self.occupant[site] = cell
+            self.net_cost = [self.net_hpwl(n) for n in range(len(self.nets))]
+            self.cost = sum(self.net_cost)
@@ -0,0 +1,286 @@
+import copy
+import logging
+from collections import deque
+import eda_tree
+from netlist import Netlist
+
+# Names eliminated counts the nodes read off constant outputs, and the nodes sharing merges, under.
+CONSTANT_PROPAGATION = "constant propagation"
+STRUCTURAL_HASHING = "structural hashing"
+
+
+# A Rewriter rewrites a Netlist to a fixed point with a table of rules. Each rule is (name, behaviors, apply), where
+# apply(rewriter, id, fanins) is tried on every node computing one of behaviors, given the node's current fan-ins, and
+# returns the node to replace it with, or None if the rule doesn't apply. Nodes are taken from a worklist, and when
+# one is replaced the nodes using it go back on the worklist, so rewriting runs until no rule applies anywhere,
+# without recursion.
+#
+# When the netlist shares, a node found to compute the same thing over the same fan-ins as another is replaced by it
+# as it's taken from the worklist, which counts as structural hashing, so rules see the fan-ins the sharing merges.
+#
+# Replaced nodes are forwarded to their replacement rather than changed in place, and every node counts the nodes
+# and outputs using it, so each rewrite knows exactly which nodes (inputs included) it left unused. eliminated[rule]
+# is the number of nodes each rule removed, less the nodes it added, so the totals add up to the number of nodes
+# rewriting removed. Standard cells and inputs are never rewritten.
+class Rewriter:
+    def __init__(self, netlist: Netlist, rules: list[tuple]):
+        # Rewriting adds nodes to the netlist, so work on a copy holding only the nodes in use. The copy doesn't
+        # share as nodes are added, since a rule could otherwise get back a node that's already been left unused;
+        # nodes are shared as they're taken from the worklist instead (if netlist shares), through hashed.
+        self.share = netlist.share
+        self.netlist = copy.deepcopy(netlist.trim())
+        self.netlist.share = False
+        self.rules = rules
+        self.eliminated = {name: 0 for (name, _, _) in rules}
+
+        count = len(self.netlist)
+        self.forward: dict[int, int] = {}
+        self.dead = bytearray(count)
+        self.refs = [0] * count
+        self.fanouts: list[list[int]] = [[] for _ in range(count)]
+        for id in range(count):
+            for fanin in self.netlist.children(id):
+                self.refs[fanin] += 1
+                self.fanouts[fanin].append(id)
+        for id in self.netlist.outputs.values():
+            self.refs[id] += 1
+
+        # Nodes by (code, fan-ins), when sharing. An entry can be stale, and is checked before it's used.
+        self.hashed: dict[tuple, int] = {}
+        self.constants: dict[bool, int] = {}
+        self.created = 0
+        self.worklist = deque(range(count))
+        self.queued = bytearray([1]) * count
+
+    # find(id) returns the node id has been replaced by, or id if it hasn't been.
+    def find(self, id: int) -> int:
+        root = id
+        while root in self.forward:
+            root = self.forward[root]
+        while id != root:
+            (self.forward[id], id) = (root, self.forward[id])
+        return root
+
+    # node(behavior, fanins) adds a node computing behavior over fanins.
+    def node(self, behavior: eda_tree.NodeBehavior, fanins: list[int]) -> int:
+        id = self.netlist.add(behavior, fanins)
+        self.created += 1
+        self.dead.append(0)
+        self.refs.append(0)
+        self.fanouts.append([])
+        self.queued.append(0)
+        for fanin in self.netlist.children(id):
+            self.refs[fanin] += 1
+            self.fanouts[fanin].append(id)
+        self.push(id)
+        return id
+
+    def constant(self, value: bool) -> int:
+        if not value in self.constants or self.dead[self.constants[value]]:
+            self.constants[value] = self.node(
+                eda_tree.ONE if value else eda_tree.ZERO, [])
+        return self.constants[value]
+
+    # value(id) returns the value of a constant node, or None if id isn't constant.
+    def value(self, id: int) -> bool | None:
+        match self.netlist.behavior(id).name:
+            case "0": return False
+            case "1": return True
+        return None
+
+    def is_not(self, id: int) -> bool:
+        return self.netlist.behavior(id).name == eda_tree.NOT.name
+
+    def push(self, id: int):
+        if not self.queued[id]:
+            self.queued[id] = 1
+            self.worklist.append(id)
+
+    # run() applies the rules until none applies, and returns the rewritten netlist.
+    def run(self) -> Netlist:
+        while self.worklist:
+            id = self.worklist.popleft()
+            self.queued[id] = 0
+            if self.dead[id] or id in self.forward or id in self.netlist.names \
+                    or self.netlist.type(id) != "verilog":
+                continue
+
+            name = self.netlist.behavior(id).name
+            fanins = [self.find(fanin) for fanin in self.netlist.children(id)]
+            if self.share:
+                key = self.key(id)
+                other = self.hashed.get(key)
+                if other != None and other != id and not self.dead[other] and not other in self.forward \
+                        and self.key(other) == key:
+                    self.charge(STRUCTURAL_HASHING, self.replace(id, other))
+                    continue
+                self.hashed[key] = id
+
+            for (rule, behaviors, apply) in self.rules:
+                if not name in behaviors:
+                    continue
+                self.created = 0
+                replacement = apply(self, id, fanins)
+                if replacement != None:
+                    self.charge(rule, self.replace(id, replacement) - self.created)
+                    break
+
+        return self.__read_off__()
+
+    # charge(rule, eliminated) counts eliminated nodes as removed by rule.
+    def charge(self, rule: str, eliminated: int):
+        self.eliminated[rule] = self.eliminated.get(rule, 0) + eliminated
+
+    # key(id) returns what id computes over its current fan-ins, which identical nodes share.
+    def key(self, id: int) -> tuple:
+        fanins = [self.find(fanin) for fanin in self.netlist.children(id)]
+        if self.netlist.behavior(id).name in eda_tree.COMMUTATIVE:
+            fanins.sort()
+        return (self.netlist.codes[id], tuple(fanins))
+
+    # replace(id, replacement) forwards id to replacement and returns the number of nodes left unused.
+    def replace(self, id: int, replacement: int) -> int:
+        self.refs[replacement] += self.refs[id]
+        self.fanouts[replacement] += self.fanouts[id]
+        for fanout in self.fanouts[id]:
+            self.push(fanout)
+        self.forward[id] = replacement
+        self.push(replacement)
+
+        unused = 0
+        stack = [id]
+        while stack:
+            node = stack.pop()
+            self.dead[node] = 1
+            self.refs[node] = 0
+            unused += 1
+            for fanin in self.netlist.children(node):
+                fanin = self.find(fanin)
+                self.refs[fanin] -= 1
+                if self.refs[fanin] == 0:
+                    stack.append(fanin)
+        return unused
+
+    # __read_off__() returns the netlist of the nodes the outputs use once every replacement is followed. Outputs
+    # that are constant are built from the first input, as NAND(a, NOT a) for 1, and NOT of that for 0, since
+    # there's no standard cell for a constant, and the nodes that takes are charged to constant propagation. When
+    # the netlist shares, nodes rewriting left identical are merged, which is counted as structural hashing.
+    def __read_off__(self) -> Netlist:
+        new = Netlist(self.share)
+        built: dict[int, int] = {}
+
+        def constant(value: bool) -> int:
+            if not self.netlist.inputs:
+                raise ValueError("Can't build a constant output without inputs")
+            input = min(self.netlist.inputs)
+            # An input the outputs use is already counted, whether or not it's been read off yet.
+            size = len(new) + (self.refs[self.netlist.inputs[input]] > 0 and not input in new.inputs)
+            a = new.input(input)
+            one = new.add(eda_tree.NAND, [a, new.add(eda_tree.NOT, [a])])
+            id = one if value else new.add(eda_tree.NOT, [one])
+            # The constant node is gone, and whatever building it added is new.
+            self.charge(CONSTANT_PROPAGATION, 1 - (len(new) - size))
+            return id
+
+        for output in self.netlist.outputs.values():
+            stack = [(self.find(output), False)]
+            while stack:
+                (id, expanded) = stack.pop()
+                if id in built:
+                    continue
+
+                fanins = [self.find(fanin)
+                          for fanin in self.netlist.children(id)]
+                if id in self.netlist.names:
+                    built[id] = new.input(self.netlist.names[id])
+                elif self.value(id) != None:
+                    built[id] = constant(self.value(id))
+                elif expanded:
+                    (behavior, type) = self.netlist.kinds[self.netlist.codes[id]]
+                    size = len(new)
+                    built[id] = new.add(
+                        behavior, [built[fanin] for fanin in fanins], type)
+                    if len(new) == size:
+                        self.charge(STRUCTURAL_HASHING, 1)
+                else:
+                    stack.append((id, True))
+                    stack += [(fanin, False) for fanin in fanins]
+
+        new.outputs = {output: built[self.find(id)]
+                       for (output, id) in self.netlist.outputs.items()}
+        return new
+
+
+# The rules. Each takes (rewriter, id, fanins) and returns id's replacement or None.
+
+# Buffers pass their fan-in through.
+def __buffer__(r: Rewriter, id: int, fanins: list[int]) -> int | None:
+    return fanins[0]
+
+
+# NAND/NOT normalization: a & b is NOT(NAND(a, b)) and a | b is NAND(NOT a, NOT b).
+def __nand_not__(r: Rewriter, id: int, fanins: list[int]) -> int | None:
+    if r.netlist.behavior(id).name == eda_tree.AND.name:
+        return r.node(eda_tree.NOT, [r.node(eda_tree.NAND, fanins)])
+    return r.node(eda_tree.NAND, [r.node(eda_tree.NOT, [fanin]) for fanin in fanins])
+
+
+# XOR decomposition: a ^ b is NAND(NAND(a, t), NAND(b, t)) where t is NAND(a, b).
+def __xor__(r: Rewriter, id: int, fanins: list[int]) -> int | None:
+    (a, b) = fanins
+    t = r.node(eda_tree.NAND, [a, b])
+    return r.node(eda_tree.NAND, [r.node(eda_tree.NAND, [a, t]), r.node(eda_tree.NAND, [b, t])])
+
+
+# Double negation: NOT(NOT a) is a.
+def __double_negation__(r: Rewriter, id: int, fanins: list[int]) -> int | None:
+    if not r.is_not(fanins[0]):
+        return None
+    return r.find(r.netlist.children(fanins[0])[0])
+
+
+# Constant propagation: NOT of a constant is constant, NAND(0, a) and NAND(a, NOT a) are 1, and NAND(1, a) and
+# NAND(a, a) are NOT a.
+def __constants__(r: Rewriter, id: int, fanins: list[int]) -> int | None:
+    values = [r.value(fanin) for fanin in fanins]
+    if r.netlist.behavior(id).name == eda_tree.NOT.name:
+        return None if values[0] == None else r.constant(not values[0])
+
+    (a, b) = fanins
+    if False in values:
+        return r.constant(True)
+    if values[0] == True:
+        return r.node(eda_tree.NOT, [b])
+    if values[1] == True or a == b:
+        return r.node(eda_tree.NOT, [a])
+    if (r.is_not(a) and r.find(r.netlist.children(a)[0]) == b) or \
+            (r.is_not(b) and r.find(r.netlist.children(b)[0]) == a):
+        return r.constant(True)
+    return None
+
+
+GATES = {eda_tree.NOT.name, eda_tree.NAND.name}
+
+# The rules, in the order they're tried on each node. There's no De Morgan rule: NAND/NOT normalization already
+# turns ~a & ~b and ~a | ~b into the gates De Morgan would, once double negation runs, and rewriting ~a & ~b
+# as ~(a | b) only duplicates ~a and ~b when something else uses them.
+RULES = [
+    ("buffer removal", {eda_tree.WIRE.name, eda_tree.OUTPUT.name}, __buffer__),
+    ("NAND/NOT normalization", {eda_tree.AND.name, eda_tree.OR.name}, __nand_not__),
+    ("XOR decomposition", {eda_tree.XOR.name}, __xor__),
+    ("double negation", {eda_tree.NOT.name}, __double_negation__),
+    (CONSTANT_PROPAGATION, GATES, __constants__),
+]
+
+# The rules that bring a design down to NAND and NOT, which is what cannonicalization does.
+CANNONICALIZE = RULES[:3]
+
+
+# rewrite(netlist, rules) rewrites netlist with rules until none applies. It returns the rewritten netlist and the
+# number of nodes each rule eliminated.
+def rewrite(netlist: Netlist, rules: list[tuple] = RULES) -> tuple[Netlist, dict[str, int]]:
+    rewriter = Rewriter(netlist, rules)
+    result = rewriter.run()
+    for (rule, eliminated) in rewriter.eliminated.items():
+        logging.debug(f"{rule} eliminated {eliminated} nodes")
+    return (result, rewriter.eliminated)
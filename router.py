@@ -0,0 +1,110 @@
+import heapq
+import numpy as np
+
+# Search strategies for cheapest_path(). DIJKSTRA expands cells cheapest first; ASTAR orders the frontier by the cost
+# so far plus the Manhattan distance to the nearest target.
+DIJKSTRA = "dijkstra"
+ASTAR = "astar"
+
+NEIGHBORS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+# cheapest_path(costs, sources, targets, mode, steps, via_cost, flat, scratch) finds the cheapest path from any of sources to any of
+# targets through a stack of routing layers. costs is a float array indexed [layer, x, y] holding the cost of entering
+# each cell (at least 1, or inf for obstacles), and cells are (layer, x, y). Moving within layer l costs steps[l][0]
+# times the cost of the cell entered along x, and steps[l][1] times along y (both 1 by default), and moving to the
+# layer above or below through a via costs via_cost times. Targets can always be entered, at cost 1. flat is costs
+# flattened to a list, for callers searching the same costs several times to convert them once, and scratch is a
+# pair of lists the size of flat, all inf and all -1, for the search to use instead of allocating its own. Only the
+# cells the search reached are reset afterwards, so scratch can be used again.
+# It returns the cells on the path, from the target reached up to and including the source it started from, or None
+# if no target can be reached, and the number of cells that were expanded.
+def cheapest_path(costs: np.ndarray, sources: list[tuple[int, int, int]], targets: list[tuple[int, int, int]], mode: str = DIJKSTRA,
+                  steps: list[tuple[float, float]] | None = None, via_cost: float = 1, flat: list[float] | None = None,
+                  scratch: tuple[list[float], list[int]] | None = None) -> tuple[list[tuple[int, int, int]] | None, int]:
+    if mode != DIJKSTRA and mode != ASTAR:
+        raise ValueError("Unknown routing mode", mode)
+
+    # Cells are numbered (layer * width + x) * height + y, and the search runs on flat lists, which index much
+    # faster than NumPy.
+    (layers, width, height) = costs.shape
+    if steps == None:
+        steps = [(1, 1)] * layers
+    cost = costs.ravel().tolist() if flat == None else flat
+    (best, previous) = ([float("inf")] * len(cost), [-1] * len(cost)) if scratch == None else scratch
+    # The cells whose best the search set, to reset in scratch.
+    touched = []
+
+    def number(cell: tuple[int, int, int]) -> int:
+        return (cell[0] * width + cell[1]) * height + cell[2]
+
+    def unnumber(cell: int) -> tuple[int, int, int]:
+        (rest, y) = divmod(cell, height)
+        return (*divmod(rest, width), y)
+
+    # Targets cost 1 for this search only, since flat can be searched again.
+    last = {number(target) for target in targets}
+    saved = [(cell, cost[cell]) for cell in last]
+    for cell in last:
+        cost[cell] = 1.0
+    corners = {(x, y) for (_, x, y) in targets}
+
+    # Every step costs at least 1, so the Manhattan distance to the nearest target never overestimates the remaining cost.
+    def estimate(x: int, y: int) -> int:
+        if mode == DIJKSTRA:
+            return 0
+        return min(abs(x - tx) + abs(y - ty) for (tx, ty) in corners)
+
+    frontier = []
+    for source in sources:
+        cell = number(source)
+        best[cell] = 0.0
+        touched.append(cell)
+        frontier.append((estimate(source[1], source[2]), 0.0, cell))
+    heapq.heapify(frontier)
+
+    expansions = 0
+    reached = -1
+    while frontier:
+        (_, distance, cell) = heapq.heappop(frontier)
+        if distance > best[cell]:
+            # Stale entry, a cheaper path to this cell was found after it was pushed.
+            continue
+
+        expansions += 1
+        if cell in last:
+            reached = cell
+            break
+
+        (layer, x, y) = unnumber(cell)
+        (step_x, step_y) = steps[layer]
+        moves = [(nx, ny, layer, step_x if dx else step_y) for (dx, dy) in NEIGHBORS
+                 for (nx, ny) in [(x + dx, y + dy)] if 0 <= nx < width and 0 <= ny < height]
+        moves += [(x, y, other, via_cost) for other in (layer - 1, layer + 1) if 0 <= other < layers]
+
+        for (nx, ny, nlayer, factor) in moves:
+            neighbor = (nlayer * width + nx) * height + ny
+            candidate = distance + cost[neighbor] * factor
+            if candidate < best[neighbor]:
+                if best[neighbor] == float("inf"):
+                    touched.append(neighbor)
+                best[neighbor] = candidate
+                previous[neighbor] = cell
+                heapq.heappush(
+                    frontier, (candidate + estimate(nx, ny), candidate, neighbor))
+
+    for (cell, value) in saved:
+        cost[cell] = value
+
+    path = None
+    if reached != -1:
+        path = [unnumber(reached)]
+        cell = reached
+        while previous[cell] != -1:
+            cell = previous[cell]
+            path.append(unnumber(cell))
+
+    for cell in touched:
+        best[cell] = float("inf")
+        previous[cell] = -1
+    return (path, expansions)
@@ -0,0 +1,105 @@
+import numpy as np
+
+# Columns of a segment row: a straight run from (layer0, x0, y0) to (layer1, x1, y1), inclusive. A run along a
+# layer changes only x or only y, and a via stack changes only the layer.
+LAYER0, X0, Y0, LAYER1, X1, Y1 = range(6)
+
+
+# A Routes stores the routed geometry of every net as run-length encoded segments, one int32 array of segment rows
+# per net, so a route costs memory in proportion to its number of bends rather than its length or the chip's area.
+class Routes:
+    def __init__(self):
+        self.segments: dict[str, np.ndarray] = {}
+
+    # add(net, path) adds path, a list of adjacent (layer, x, y) cells, to net's geometry.
+    def add(self, net: str, path: list[tuple[int, int, int]]):
+        if len(path) < 2:
+            return
+        rows = encode(path)
+        if net in self.segments:
+            rows = np.concatenate([self.segments[net], rows])
+        self.segments[net] = rows
+
+    # remove(net) removes net's geometry, returning its segments.
+    def remove(self, net: str) -> np.ndarray:
+        return self.segments.pop(net, np.zeros((0, 6), dtype=np.int32))
+
+    # cells(net) returns every (layer, x, y) cell net's segments cover. Cells where segments meet are repeated.
+    def cells(self, net: str) -> list[tuple[int, int, int]]:
+        return [cell for row in self.segments.get(net, []) for cell in decode(row)]
+
+    # wirelength(net) returns the length of net's wires along the layers, or of every net's if net is None.
+    def wirelength(self, net: str | None = None) -> int:
+        rows = self.__rows__(net)
+        return int(np.abs(rows[:, X1] - rows[:, X0]).sum() + np.abs(rows[:, Y1] - rows[:, Y0]).sum())
+
+    # via_count(net) returns the number of vias in net's route, or in every net's if net is None.
+    def via_count(self, net: str | None = None) -> int:
+        rows = self.__rows__(net)
+        return int(np.abs(rows[:, LAYER1] - rows[:, LAYER0]).sum())
+
+    # vias(net) returns the vias in net's route, or in every net's if net is None, as (layer, x, y) joining layer and
+    # the layer above.
+    def vias(self, net: str | None = None) -> list[tuple[int, int, int]]:
+        rows = self.__rows__(net)
+        rows = rows[rows[:, LAYER1] != rows[:, LAYER0]]
+        return [(layer, int(row[X0]), int(row[Y0])) for row in rows
+                for layer in range(min(row[LAYER0], row[LAYER1]), max(row[LAYER0], row[LAYER1]))]
+
+    # rasterize(grid, value) sets every cell of grid (indexed [layer, x, y]) that a route covers to value, except
+    # cells holding a negative value other than value, which are pins.
+    def rasterize(self, grid: np.ndarray, value: int):
+        for rows in self.segments.values():
+            for row in rows:
+                region = grid[__span__(row)]
+                region[region >= 0] = value
+
+    def __rows__(self, net: str | None) -> np.ndarray:
+        if net != None:
+            return self.segments.get(net, np.zeros((0, 6), dtype=np.int32))
+        if not self.segments:
+            return np.zeros((0, 6), dtype=np.int32)
+        return np.concatenate(list(self.segments.values()))
+
+
+# encode(path) run length encodes path, a list of adjacent (layer, x, y) cells, into segment rows, one for each
+# straight run.
+def encode(path: list[tuple[int, int, int]]) -> np.ndarray:
+    rows = []
+    start = path[0]
+    direction = None
+    for (previous, cell) in zip(path, path[1:]):
+        step = (cell[0] - previous[0], cell[1] - previous[1], cell[2] - previous[2])
+        if direction != None and step != direction:
+            rows.append((*start, *previous))
+            start = previous
+        direction = step
+    rows.append((*start, *path[-1]))
+    return np.array(rows, dtype=np.int32)
+
+
+# decode(row) returns the cells a segment row covers, from its first end to its last.
+def decode(row: np.ndarray) -> list[tuple[int, int, int]]:
+    (layer0, x0, y0, layer1, x1, y1) = (int(value) for value in row)
+    length = max(abs(layer1 - layer0), abs(x1 - x0), abs(y1 - y0))
+    if length == 0:
+        return [(layer0, x0, y0)]
+    return [(layer0 + (layer1 - layer0) * i // length, x0 + (x1 - x0) * i // length, y0 + (y1 - y0) * i // length)
+            for i in range(length + 1)]
+
+
+# __span__(row) returns the slices of a [layer, x, y] grid that a segment row covers.
+def __span__(row: np.ndarray) -> tuple[slice, slice, slice]:
+    return tuple(slice(min(row[a], row[b]), max(row[a], row[b]) + 1) for (a, b) in ((LAYER0, LAYER1), (X0, X1), (Y0, Y1)))
+
+
+# encode_runs(cells) run length encodes an array of (layer, x, y) cells, sorted as np.argwhere returns them, into
+# (layer, x, y, length) runs of cells going up y.
+def encode_runs(cells: np.ndarray) -> list[tuple[int, int, int, int]]:
+    runs = []
+    for (layer, x, y) in cells.tolist():
+        if runs and runs[-1][:2] == (layer, x) and runs[-1][2] + runs[-1][3] == y:
+            runs[-1] = (layer, x, runs[-1][2], runs[-1][3] + 1)
+        else:
+            runs.append((layer, x, y, 1))
+    return runs
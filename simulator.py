@@ -0,0 +1,245 @@
+import concurrent.futures
+import itertools
+import numpy as np
+import eda_tree
+from technology import Technology
+
+# Instruction opcodes. An instruction is a tuple (opcode, destination slot, *source slots).
+COPY, NOT, AND, OR, XOR, NAND, NOR = range(7)
+
+OPCODES = {
+    eda_tree.OUTPUT.name: COPY,
+    eda_tree.WIRE.name: COPY,
+    eda_tree.NOT.name: NOT,
+    eda_tree.AND.name: AND,
+    eda_tree.OR.name: OR,
+    eda_tree.XOR.name: XOR,
+    eda_tree.NAND.name: NAND,
+    eda_tree.NOR.name: NOR,
+}
+
+WORD_BITS = 64
+# Verification shards are at least this many words, so small checks don't pay for a process pool.
+SHARD_WORDS = 256
+ALL_ONES = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+# The bit patterns of the first six inputs in an exhaustive truth table, one 64 bit word per pattern.
+LOW_PATTERNS = [
+    0xAAAAAAAAAAAAAAAA,
+    0xCCCCCCCCCCCCCCCC,
+    0xF0F0F0F0F0F0F0F0,
+    0xFF00FF00FF00FF00,
+    0xFFFF0000FFFF0000,
+    0xFFFFFFFF00000000,
+]
+
+
+# A Program is a design compiled to a flat, topologically ordered list of bitwise instructions.
+# Each slot holds a packed word of simulation vectors, one vector per bit, so every instruction
+# evaluates a gate over all the vectors at once. Slots can be Python ints (of any width) or NumPy
+# uint64 arrays.
+class Program:
+    def __init__(self, inputs: list[str], outputs: dict[str, int], instructions: list[tuple], slot_count: int):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.instructions = instructions
+        self.slot_count = slot_count
+
+    # run(values, mask) evaluates the program. values maps every input to a packed word and mask
+    # has a one for every bit in use. It returns a map from each output to its packed word.
+    def run(self, values: dict, mask) -> dict:
+        slots = [None] * self.slot_count
+        for (i, name) in enumerate(self.inputs):
+            slots[i] = values[name]
+
+        for instruction in self.instructions:
+            op = instruction[0]
+            if op == NOT:
+                slots[instruction[1]] = slots[instruction[2]] ^ mask
+            elif op == NAND:
+                slots[instruction[1]] = (
+                    slots[instruction[2]] & slots[instruction[3]]) ^ mask
+            elif op == AND:
+                slots[instruction[1]] = slots[instruction[2]] & slots[instruction[3]]
+            elif op == OR:
+                slots[instruction[1]] = slots[instruction[2]] | slots[instruction[3]]
+            elif op == XOR:
+                slots[instruction[1]] = slots[instruction[2]] ^ slots[instruction[3]]
+            elif op == NOR:
+                slots[instruction[1]] = (
+                    slots[instruction[2]] | slots[instruction[3]]) ^ mask
+            else:
+                slots[instruction[1]] = slots[instruction[2]]
+
+        return {output: slots[slot] for (output, slot) in self.outputs.items()}
+
+    # evaluate(simdata) evaluates a single vector, where simdata maps each input to a bool.
+    def evaluate(self, simdata: dict[str, bool]) -> dict[str, bool]:
+        results = self.run(
+            {name: int(bool(simdata[name])) for name in self.inputs}, 1)
+        return {output: bool(value) for (output, value) in results.items()}
+
+    # truth_table() simulates every input combination. Vector v sets input i to bit i of v, and
+    # vector v is bit v % 64 of word v // 64 of each returned uint64 array.
+    def truth_table(self) -> dict[str, np.ndarray]:
+        vector_count = 1 << len(self.inputs)
+        word_count = (vector_count + WORD_BITS - 1) // WORD_BITS
+
+        results = self.run(self.exhaustive_vectors(0, word_count), ALL_ONES)
+        if vector_count < WORD_BITS:
+            unused = np.uint64((1 << vector_count) - 1)
+            results = {output: packed & unused for (
+                output, packed) in results.items()}
+        return results
+
+    # exhaustive_vectors(first, last) returns words first up to (but excluding) last of the exhaustive
+    # truth table inputs, packed like truth_table().
+    def exhaustive_vectors(self, first: int, last: int) -> dict[str, np.ndarray]:
+        words = np.arange(first, last, dtype=np.uint64)
+
+        values = {}
+        for (i, name) in enumerate(self.inputs):
+            if i < len(LOW_PATTERNS):
+                values[name] = np.full(
+                    len(words), LOW_PATTERNS[i], dtype=np.uint64)
+            else:
+                values[name] = np.where(
+                    (words >> np.uint64(i - len(LOW_PATTERNS))) & np.uint64(1), ALL_ONES, np.uint64(0))
+        return values
+
+    # random_vectors(count, seed) returns count random vectors for the program's inputs, packed into uint64 words.
+    def random_vectors(self, count: int, seed: int | None = None) -> dict[str, np.ndarray]:
+        rng = np.random.default_rng(seed)
+        word_count = (count + WORD_BITS - 1) // WORD_BITS
+        return {name: rng.integers(0, ALL_ONES, size=word_count, dtype=np.uint64, endpoint=True) for name in self.inputs}
+
+    # simulate(values) evaluates packed uint64 vectors like those returned by random_vectors.
+    def simulate(self, values: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+        return self.run(values, ALL_ONES)
+
+
+# compile_program(trees, tech, inputs) compiles trees, either one tree or a map from output name to tree, into a
+# Program. Mapped standard cells are expanded into their canonical trees, so mapped netlists need the
+# Technology they were mapped with. inputs fixes the order of the inputs, otherwise they are sorted by name.
+def compile_program(trees: dict[str, eda_tree.EDANode] | eda_tree.EDANode, tech: Technology | None = None, inputs: list[str] | None = None) -> Program:
+    if isinstance(trees, eda_tree.EDANode):
+        trees = {eda_tree.OUTPUT_NAME: trees}
+
+    if inputs == None:
+        inputs = sorted({node.children[0] for tree in trees.values() for node in tree.postorder()
+                         if node.behavior.name == eda_tree.INPUT_NAME})
+
+    input_slots = {name: i for (i, name) in enumerate(inputs)}
+    instructions = []
+    slot_count = len(inputs)
+
+    # emit(op, sources) appends an instruction and returns its destination slot.
+    def emit(op, sources):
+        nonlocal slot_count
+        instructions.append((op, slot_count, *sources))
+        slot_count += 1
+        return slot_count - 1
+
+    # expand(tree, bindings) emits the instructions for a generic (not mapped) tree, where bindings
+    # maps input names to slots.
+    def expand(tree, bindings):
+        slots = {}
+        for node in tree.postorder():
+            if node.behavior.name == eda_tree.INPUT_NAME:
+                slots[node.uuid] = bindings[node.children[0]]
+            else:
+                slots[node.uuid] = emit(
+                    OPCODES[node.behavior.name], [slots[child.uuid] for child in node.children])
+        return slots[tree.uuid]
+
+    slots = {}
+    for tree in trees.values():
+        for node in tree.postorder():
+            if node.uuid in slots:
+                continue
+
+            children = [slots[child.uuid] for child in node.children] \
+                if node.behavior.name != eda_tree.INPUT_NAME else []
+
+            if node.behavior.name == eda_tree.INPUT_NAME:
+                slots[node.uuid] = input_slots[node.children[0]]
+            elif node.__type__ == "stdcell":
+                if tech == None:
+                    raise TypeError(
+                        "Compiling a mapped netlist needs its technology", node.behavior.name)
+                cell = tech.cell(node.behavior.name)
+                slots[node.uuid] = expand(
+                    cell.tree, dict(zip(cell.inputs, children)))
+            else:
+                slots[node.uuid] = emit(
+                    OPCODES[node.behavior.name], children)
+
+    outputs = {output: slots[tree.uuid] for (output, tree) in trees.items()}
+    return Program(inputs, outputs, instructions, slot_count)
+
+
+# find_counterexample(reference, candidate, jobs, exhaustive_limit, random_count, seed) checks that two
+# programs over the same inputs compute the same outputs. Programs with at most exhaustive_limit inputs
+# are checked on every vector, bigger ones on random_count random vectors. The vectors are split into
+# shards, which run in a process pool when jobs > 1. It returns (output, simdata) for the first vector
+# where the programs disagree, or None if they agree on every vector checked.
+def find_counterexample(reference: Program, candidate: Program, jobs: int = 1, exhaustive_limit: int = 20, random_count: int = 1 << 16, seed: int = 0) -> None | tuple[str, dict[str, bool]]:
+    if reference.inputs != candidate.inputs:
+        raise TypeError("Programs have different inputs",
+                        reference.inputs, candidate.inputs)
+    if reference.outputs.keys() != candidate.outputs.keys():
+        raise TypeError("Programs have different outputs",
+                        list(reference.outputs), list(candidate.outputs))
+
+    if len(reference.inputs) <= exhaustive_limit:
+        word_count = ((1 << len(reference.inputs)) +
+                      WORD_BITS - 1) // WORD_BITS
+    else:
+        word_count = (random_count + WORD_BITS - 1) // WORD_BITS
+
+    shard_count = max(1, min(jobs * 4, word_count // SHARD_WORDS))
+    bounds = [word_count * i // shard_count for i in range(shard_count + 1)]
+    shards = [(bounds[i], bounds[i + 1], None if len(reference.inputs) <= exhaustive_limit else seed + i)
+              for i in range(shard_count)]
+
+    if jobs > 1 and shard_count > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(__check_shard__, itertools.repeat(
+                reference), itertools.repeat(candidate), shards))
+    else:
+        results = [__check_shard__(reference, candidate, shard)
+                   for shard in shards]
+
+    return next((result for result in results if result != None), None)
+
+
+# __check_shard__(reference, candidate, shard) compares two programs over one shard (first word, last word,
+# random seed or None for exhaustive) and returns the first counterexample in it, or None.
+def __check_shard__(reference: Program, candidate: Program, shard: tuple) -> None | tuple[str, dict[str, bool]]:
+    (first, last, seed) = shard
+    if seed == None:
+        values = reference.exhaustive_vectors(first, last)
+    else:
+        rng = np.random.default_rng(seed)
+        values = {name: rng.integers(0, ALL_ONES, size=last - first, dtype=np.uint64, endpoint=True)
+                  for name in reference.inputs}
+
+    expected = reference.simulate(values)
+    actual = candidate.simulate(values)
+
+    if seed == None and len(reference.inputs) < len(LOW_PATTERNS):
+        unused = np.uint64((1 << (1 << len(reference.inputs))) - 1)
+    else:
+        unused = ALL_ONES
+
+    for output in reference.outputs:
+        difference = (expected[output] ^ actual[output]) & unused
+        words = np.flatnonzero(difference)
+        if len(words) > 0:
+            word = words[0]
+            bit = (int(difference[word]) & -int(difference[word])).bit_length() - 1
+            simdata = {name: bool((int(packed[word]) >> bit) & 1)
+                       for (name, packed) in values.items()}
+            return (output, simdata)
+
+    return None
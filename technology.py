@@ -1,46 +1,80 @@
+import concurrent.futures
+import functools
+import hashlib
+import itertools
 import json
+import os
+import pickle
 import lexparse
 import eda_tree
 import logging
 import copy
 
 
+# A Pin is a cell pin at (x, y) within the cell, which blocks routing on the layers (indexes into
+# Technology.layers) listed in layers.
 class Pin:
-    def __init__(self, x: int, y: int, name: str):
+    def __init__(self, x: int, y: int, name: str, layers: list[int] | None = None):
         self.x = x
         self.y = y
         self.name = name
+        self.layers = [0] if layers == None else layers
+
+
+# Preferred routing directions of a Layer. Routes can run the other way on a layer, at a cost.
+HORIZONTAL = "horizontal"
+VERTICAL = "vertical"
+
+
+# A Layer is a metal routing layer, with a preferred direction (None if it has none).
+class Layer:
+    def __init__(self, name: str, direction: str | None = None):
+        if not direction in (None, HORIZONTAL, VERTICAL):
+            raise ValueError("Unknown layer direction", name, direction)
+        self.name = name
+        self.direction = direction
 
 
 class StandardCell:
-    def __init__(self, name: str, tree: eda_tree.EDANode, inputs: list[str], pins: list[Pin], price: int, dump_mermaid=False):
+    def __init__(self, name: str, tree: eda_tree.EDANode, inputs: list[str], pins: list[Pin], price: int, mermaid_dir: str | None = None):
         self.name = name
         self.inputs = inputs
         self.price = price
-        self.behavior = eda_tree.NodeBehavior(name, len(inputs), tree.simulate)
+        self.behavior = eda_tree.NodeBehavior(
+            name, len(inputs), functools.partial(__simulate_cell__, tree, inputs))
         self.pins = pins
         self.output_pin = [p for p in pins if not p.name in inputs][0]
 
-        if dump_mermaid:
-            file = f"mermaid/stdcell-{name}.mmd"
+        if mermaid_dir != None:
+            file = os.path.join(mermaid_dir, f"stdcell-{name}.mmd")
             logging.info(f"Writing file {file}")
-            tree.dump_mermaid(open(file, "w"))
+            with open(file, "w") as f:
+                tree.dump_mermaid(f)
+
+        # netlist and rewrite import this module, so they're imported once it's loaded.
+        import netlist
+        import rewrite
 
         logging.debug(f"Cannonicalizing {name}")
-        self.tree = tree.cannonicalize()
+        pattern = netlist.from_trees({self.output_pin.name: tree})
+        (pattern, _) = rewrite.rewrite(pattern, rewrite.CANNONICALIZE)
+        self.tree = pattern.to_trees()[self.output_pin.name]
 
-        if dump_mermaid:
-            file = f"mermaid/stdcell-{name}-cannonical.mmd"
+        if mermaid_dir != None:
+            file = os.path.join(mermaid_dir, f"stdcell-{name}-cannonical.mmd")
             logging.info(f"Writing file {file}")
-            self.tree.dump_mermaid(open(file, "w"))
+            with open(file, "w") as f:
+                self.tree.dump_mermaid(f)
 
         logging.debug(f"Simplifying {name}")
-        self.tree = self.tree.simplify()
+        (pattern, _) = rewrite.rewrite(pattern)
+        self.tree = pattern.to_trees()[self.output_pin.name]
 
-        if dump_mermaid:
-            file = f"mermaid/stdcell-{name}-simplified.mmd"
+        if mermaid_dir != None:
+            file = os.path.join(mermaid_dir, f"stdcell-{name}-simplified.mmd")
             logging.info(f"Writing file {file}")
-            self.tree.dump_mermaid(open(file, "w"))
+            with open(file, "w") as f:
+                self.tree.dump_mermaid(f)
 
     def generateNode(self, children):
         node = eda_tree.EDANode.with_children(
@@ -48,16 +82,75 @@ class StandardCell:
         node.set_type("stdcell")
         return node
 
-    def match(self, other: eda_tree.EDANode) -> None | tuple[list[eda_tree.EDANode], int]:
-        result = other.match(self.tree)
-        if result == None:
-            return None
 
-        return (result, self.price)
+# A MatchIndex is a discrimination tree over the canonical trees of a library's standard cells.
+# Each pattern is flattened in pre-order into (behavior name, child count) symbols, with inputs
+# becoming wildcards, so matching a node only walks the patterns that share its shape. An input used
+# more than once in a pattern (as in the NAND form of an XOR) must be bound to the same node each time.
+class MatchIndex:
+    WILDCARD = "*"
+
+    def __init__(self, cells: list[StandardCell]):
+        self.next: dict[tuple[str, int] | str, MatchIndex] = {}
+        self.cells: list[tuple[int, StandardCell, list[str]]] = []
+
+        for (order, cell) in enumerate(cells):
+            self.add(order, cell)
+
+    def add(self, order: int, cell: StandardCell):
+        index = self
+        names = []
+        stack = [cell.tree]
+        while stack:
+            node = stack.pop()
+            if node.behavior.name == "Input":
+                key = MatchIndex.WILDCARD
+                names.append(node.children[0])
+            else:
+                key = (node.behavior.name, len(node.children))
+                stack += reversed(node.children)
+
+            if not key in index.next:
+                index.next[key] = MatchIndex([])
+            index = index.next[key]
+
+        index.cells.append((order, cell, names))
+
+    # match(node) returns (order, cell, leaves) for every cell whose pattern matches at node, where order
+    # is the cell's position in the library. Results are in library order. The leaves are the subtrees
+    # of node bound to the cell's inputs, in the order of cell.inputs.
+    def match(self, node: eda_tree.EDANode) -> list[tuple[int, StandardCell, list[eda_tree.EDANode]]]:
+        results = []
+        stack = [(self, [node], [])]
+        while stack:
+            (index, pending, leaves) = stack.pop()
+            if not pending:
+                for (order, cell, names) in index.cells:
+                    bound = __bind__(cell, names, leaves)
+                    if bound != None:
+                        results.append((order, cell, bound))
+                continue
+
+            subject = pending[-1]
+            rest = pending[:-1]
+
+            wildcard = index.next.get(MatchIndex.WILDCARD)
+            if wildcard != None:
+                stack.append((wildcard, rest, leaves + [subject]))
+
+            if subject.behavior.name != "Input":
+                specific = index.next.get(
+                    (subject.behavior.name, len(subject.children)))
+                if specific != None:
+                    stack.append(
+                        (specific, rest + subject.children[::-1], leaves))
+
+        results.sort(key=lambda result: result[0])
+        return results
 
 
 class Technology:
-    def __init__(self, json_file: str, dump_stdcell_mermaid=False):
+    def __init__(self, json_file: str, stdcell_mermaid_dir: str | None = None):
         json_spec: str
         with open(json_file) as f:
             json_spec = json.load(f)
@@ -65,8 +158,17 @@ class Technology:
         self.name: str = json_spec["name"]
         self.description: str = json_spec["description"]
         self.verilog: str = json_spec["verilog"]
+        self.hash: str = library_hash(json_file)
         self.cells: list[StandardCell] = []
 
+        # Routing layers, bottom up. Libraries that don't declare any route on a single layer. Pins block
+        # the layers named by their "layers", or by the library's "pin_layers", or the bottom layer.
+        self.layers: list[Layer] = [Layer(layer["name"], layer.get("direction"))
+                                    for layer in json_spec.get("layers", [{"name": "M1"}])]
+        self.via_cost: float = json_spec.get("via_cost", 2)
+        self.pin_layers: list[int] = [self.layer(name) for name in json_spec.get(
+            "pin_layers", [self.layers[0].name])]
+
         logging.debug(f"Standard cell library {self.name}")
         logging.debug(f"Reading Verilog descriptions at {self.verilog}")
 
@@ -82,8 +184,10 @@ class Technology:
 
             pins: list[Pin] = []
             for pin in stdcell["pins"]:
+                layers = [self.layer(name) for name in pin["layers"]] \
+                    if "layers" in pin else self.pin_layers
                 pins.append(
-                    Pin(pin["position"][0], pin["position"][1], pin["name"]))
+                    Pin(pin["position"][0], pin["position"][1], pin["name"], layers))
 
             self.cells.append(StandardCell(
                 stdcell["name"],
@@ -91,27 +195,228 @@ class Technology:
                 spec.inputs,
                 pins,
                 stdcell["price"],
-                dump_mermaid=dump_stdcell_mermaid))
+                mermaid_dir=stdcell_mermaid_dir))
+
+        self.cells_by_name: dict[str, StandardCell] = {
+            cell.name: cell for cell in self.cells}
+        self.index = MatchIndex(self.cells)
+
+    # layer(name) returns the index of the routing layer called name.
+    def layer(self, name: str) -> int:
+        for (i, layer) in enumerate(self.layers):
+            if layer.name == name:
+                return i
+        raise ValueError("Unknown layer", name)
+
+    # cell(name) returns the standard cell called name.
+    def cell(self, name: str) -> StandardCell:
+        return self.cells_by_name[name]
+
+    # cover(roots) costs the cheapest cover of every node reachable from roots. Every node is costed
+    # once, bottom-up, against only the cells the match index says can match it. best[uuid] is
+    # (cost, cell index, leaf uuids) for the cheapest cover rooted at that node, or None if there isn't one.
+    def cover(self, roots: list[eda_tree.EDANode]) -> dict:
+        best: dict = {}
+        for root in roots:
+            for node in root.postorder():
+                if node.uuid in best:
+                    continue
+
+                if node.behavior.name == "Input":
+                    best[node.uuid] = (0, None, [])
+                    continue
+
+                best[node.uuid] = None
+                for (order, cell, leaves) in self.index.match(node):
+                    if any(best[leaf.uuid] == None for leaf in leaves):
+                        continue
+
+                    cost = cell.price + \
+                        sum(best[leaf.uuid][0] for leaf in leaves)
+                    if best[node.uuid] == None or cost < best[node.uuid][0]:
+                        best[node.uuid] = (
+                            cost, order, [leaf.uuid for leaf in leaves])
+
+        return best
 
     # map(tree) covers tree with standard cells
     def map(self, tree: eda_tree.EDANode) -> tuple[eda_tree.EDANode, int]:
-        if tree.behavior.name == "Input":
-            return (tree, 0)
-
-        min_cost_mapping = (None, -1)
-        for cell in self.cells:
-            logging.debug(f"Attempting to match {cell.name}")
-            child_result = cell.match(tree)
-            if child_result != None:
-                cost = child_result[1]
-                children: eda_tree.EDANode = []
-                for child in child_result[0]:
-                    (new_child, addtl_cost) = self.map(child)
-                    cost += addtl_cost
-                    children += [new_child]
-
-                if min_cost_mapping[1] == -1 or cost < min_cost_mapping[1]:
-                    min_cost_mapping = (cell.generateNode(children), cost)
-
-        assert (min_cost_mapping[0] != None)
-        return min_cost_mapping
+        (mapped, price) = self.__read_off__([tree], self.cover([tree]))
+        return (mapped[0], price)
+
+    # map_cones(cones, jobs) covers every output cone of a design with standard cells. Logic shared
+    # between cones is mapped once. Groups of cones that share nothing are independent, so with
+    # jobs > 1 they are costed in parallel in a process pool.
+    def map_cones(self, cones: dict[str, eda_tree.EDANode], jobs: int = 1) -> tuple[dict[str, eda_tree.EDANode], int]:
+        roots = list(cones.values())
+        groups = __independent_groups__(roots)
+
+        best: dict = {}
+        if jobs > 1 and len(groups) > 1:
+            logging.debug(
+                f"Covering {len(groups)} independent groups of cones with {jobs} processes")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+                for group_best in pool.map(__cover__, itertools.repeat(self), groups):
+                    best.update(group_best)
+        else:
+            for group in groups:
+                best.update(self.cover(group))
+
+        (mapped, price) = self.__read_off__(roots, best)
+        return (dict(zip(cones.keys(), mapped)), price)
+
+    # __read_off__(roots, best) builds the mapped design chosen by cover, building each mapped node
+    # after the nodes it is mapped onto. A node shared by several covers is only built, and paid for, once.
+    def __read_off__(self, roots: list[eda_tree.EDANode], best: dict) -> tuple[list[eda_tree.EDANode], int]:
+        nodes = {node.uuid: node for root in roots for node in root.postorder()}
+
+        mapped: dict = {}
+        price = 0
+        for root in roots:
+            assert (best[root.uuid] != None)
+
+            stack = [(root.uuid, False)]
+            while stack:
+                (uuid, expanded) = stack.pop()
+                if uuid in mapped:
+                    continue
+
+                (_, order, leaves) = best[uuid]
+                if order == None:
+                    mapped[uuid] = nodes[uuid]
+                elif expanded:
+                    cell = self.cells[order]
+                    mapped[uuid] = cell.generateNode(
+                        [mapped[leaf] for leaf in leaves])
+                    price += cell.price
+                else:
+                    stack.append((uuid, True))
+                    for leaf in leaves:
+                        stack.append((leaf, False))
+
+        return ([mapped[root.uuid] for root in roots], price)
+
+
+# Compiled libraries are cached here unless another directory is given. Bump CACHE_VERSION whenever
+# the pickled Technology changes shape, so old entries are ignored.
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get(
+    "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "edatool")
+CACHE_VERSION = 3
+
+
+# library_hash(json_file) returns a content hash of a standard cell library, covering the JSON
+# description and the Verilog file it references.
+def library_hash(json_file: str) -> str:
+    with open(json_file, "rb") as f:
+        json_bytes = f.read()
+    verilog = json.loads(json_bytes)["verilog"]
+    with open(verilog, "rb") as f:
+        verilog_bytes = f.read()
+
+    digest = hashlib.sha256()
+    for part in [str(CACHE_VERSION).encode(), json_bytes, verilog_bytes]:
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+# load(json_file, cache_dir, stdcell_mermaid_dir) returns the Technology described by json_file. The
+# compiled library (canonical trees, pins, prices and match index) is cached in cache_dir under the
+# content hash of the library, so it's only rebuilt when the JSON or the Verilog changes. Dumping
+# mermaid files of each standard cell into stdcell_mermaid_dir needs the library to be built, so it
+# skips the cache.
+def load(json_file: str, cache_dir: str | None = DEFAULT_CACHE_DIR, stdcell_mermaid_dir: str | None = None) -> "Technology":
+    if cache_dir == None or stdcell_mermaid_dir != None:
+        return Technology(json_file, stdcell_mermaid_dir=stdcell_mermaid_dir)
+
+    # Entries are named after the library's path and contents, so a changed library replaces its old entry.
+    prefix = "technology-" + \
+        hashlib.sha256(os.path.abspath(json_file).encode()).hexdigest()[:16]
+    path = os.path.join(
+        cache_dir, f"{prefix}-{library_hash(json_file)}.pickle")
+
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                tech = pickle.load(f)
+            logging.debug(f"Loaded compiled library from {path}")
+            return tech
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable library cache {path}: {e}")
+
+    tech = Technology(json_file)
+
+    # The library is built either way, so failing to cache it (a read-only or full cache directory, or another
+    # process removing the same old entry) only costs the next run a rebuild.
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for entry in os.listdir(cache_dir):
+            if entry.startswith(prefix + "-"):
+                try:
+                    os.remove(os.path.join(cache_dir, entry))
+                except FileNotFoundError:
+                    pass
+
+        with open(temporary, "wb") as f:
+            pickle.dump(tech, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+        logging.debug(f"Cached compiled library at {path}")
+    except Exception as e:
+        logging.warning(f"Not caching the compiled library at {path}: {e}")
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+
+    return tech
+
+
+# __simulate_cell__(tree, inputs, simdata, arr) evaluates a standard cell's tree with its inputs set to arr.
+def __simulate_cell__(tree: eda_tree.EDANode, inputs: list[str], simdata, arr):
+    return tree.simulate(dict(zip(inputs, arr)))
+
+
+# __bind__(cell, names, leaves) returns the leaves a match bound to each of cell's inputs, given the input each
+# leaf matched in names, or None if an input was bound to two different nodes or to none.
+def __bind__(cell: StandardCell, names: list[str], leaves: list[eda_tree.EDANode]) -> list[eda_tree.EDANode] | None:
+    bound: dict = {}
+    for (name, leaf) in zip(names, leaves):
+        if bound.setdefault(name, leaf).uuid != leaf.uuid:
+            return None
+    if len(bound) != len(cell.inputs):
+        return None
+    return [bound[input] for input in cell.inputs]
+
+
+# __cover__(tech, roots) runs Technology.cover in a worker process.
+def __cover__(tech: Technology, roots: list[eda_tree.EDANode]) -> dict:
+    return tech.cover(roots)
+
+
+# __independent_groups__(roots) splits roots into groups that share no nodes with each other. Inputs don't count,
+# since covering never changes them, and most cones read some input another cone reads too.
+def __independent_groups__(roots: list[eda_tree.EDANode]) -> list[list[eda_tree.EDANode]]:
+    # owner[uuid] is the index of the first root that reaches the node; parent is a union-find over roots
+    owner: dict = {}
+    parent = list(range(len(roots)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (i, root) in enumerate(roots):
+        for node in root.postorder():
+            if node.behavior.name == eda_tree.INPUT_NAME:
+                continue
+            if node.uuid in owner:
+                parent[find(i)] = find(owner[node.uuid])
+            else:
+                owner[node.uuid] = i
+
+    groups: dict[int, list[eda_tree.EDANode]] = {}
+    for (i, root) in enumerate(roots):
+        groups.setdefault(find(i), []).append(root)
+    return list(groups.values())
@@ -0,0 +1,74 @@
+import io
+import pytest
+import lexparse
+import netlist
+
+
+# parse(expression) returns the tree of expression, over the inputs a, b and c.
+def parse(expression: str):
+    file = io.StringIO(
+        f"module m(input a, input b, input c, output logic y);\nassign y = {expression};\nendmodule\n")
+    return lexparse.lexparse(file)[0].trees["y"]
+
+
+# shape(tree) returns tree written out with every operator's operands in parentheses.
+def shape(tree) -> str:
+    if tree.behavior.name == "Input":
+        return tree.children[0]
+    return tree.behavior.name + "(" + ", ".join(shape(child) for child in tree.children) + ")"
+
+
+@pytest.mark.parametrize(("expression", "grouped"), [
+    ("a | b & c", "a | (b & c)"),
+    ("a & b | c", "(a & b) | c"),
+    ("a ^ b & c", "a ^ (b & c)"),
+    ("a | b ^ c", "a | (b ^ c)"),
+    ("a & b ^ c | a", "((a & b) ^ c) | a"),
+    ("~a & b", "(~a) & b"),
+    ("~a | ~b ^ c", "(~a) | ((~b) ^ c)"),
+    ("a & b & c", "(a & b) & c"),
+    ("a ^ b ^ c", "(a ^ b) ^ c"),
+    ("a | b | c", "(a | b) | c"),
+    ("~~a", "~(~(a))"),
+    ("~(a | b) & c", "(~((a | b))) & c"),
+    ("((a))", "a"),
+    ("~(~(a & ~b) | (c))", "~((~((a & (~b)))) | c)"),
+])
+def test_precedence_and_associativity(expression: str, grouped: str):
+    assert shape(parse(expression)) == shape(parse(grouped))
+
+
+def test_grouping_changes_the_tree():
+    assert shape(parse("a | b & c")) != shape(parse("(a | b) & c"))
+    assert shape(parse("a ^ b ^ c")) != shape(parse("a ^ (b ^ c)"))
+    assert shape(parse("~a & b")) != shape(parse("~(a & b)"))
+
+
+def test_deep_nesting_without_recursion():
+    depth = 5000
+    tree = parse("(" * depth + "a" + ")" * depth + " & " + "~" * depth + "b")
+    assert tree.behavior.name == "&"
+    assert len(list(tree.postorder())) == depth + 3
+    assert netlist.from_trees({"y": tree}).simulate({"a": True, "b": True}) == {"y": True}
+
+
+@pytest.mark.parametrize(("expression", "message", "column"), [
+    ("a & (b | ", "Expected an identifier, found \";\"", 21),
+    ("((a)", "Expected \")\", found \";\"", 16),
+    ("a & b)", "Expected \";\", found \")\"", 17),
+    ("a b", "Expected \";\", found \"b\"", 14),
+    ("a + b", "Expected \";\", found \"+\"", 14),
+    ("~", "Expected an identifier, found \";\"", 13),
+])
+def test_syntax_error_positions(expression: str, message: str, column: int):
+    with pytest.raises(SyntaxError) as error:
+        parse(expression)
+    assert error.value.msg == message
+    assert (error.value.lineno, error.value.offset) == (2, column)
+
+
+def test_syntax_error_at_end_of_file():
+    with pytest.raises(SyntaxError) as error:
+        lexparse.lexparse(io.StringIO("module m(input a, output logic y);\nassign y = a"))
+    assert error.value.msg == "Expected \";\", found end of file"
+    assert error.value.lineno == None
@@ -0,0 +1,164 @@
+import itertools
+import json
+import os
+import random
+import pytest
+import eda_tree
+import netlist
+import rewrite
+import technology
+from netlist import Netlist
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# random_netlist(seed, share) returns a small random netlist of verilog gates with a few outputs.
+def random_netlist(seed: int, share: bool = False) -> Netlist:
+    r = random.Random(seed)
+    design = Netlist(share)
+    ids = [design.input(f"i{k}") for k in range(r.randint(1, 5))]
+    for _ in range(r.randint(1, 40)):
+        behavior = r.choice([eda_tree.AND, eda_tree.OR, eda_tree.XOR,
+                             eda_tree.NOT, eda_tree.WIRE])
+        ids.append(design.add(
+            behavior, [r.choice(ids[-8:]) for _ in range(behavior.arg_count)]))
+    for k in range(r.randint(1, 3)):
+        design.outputs[f"o{k}"] = design.add(eda_tree.OUTPUT, [r.choice(ids)])
+    return design
+
+
+# vectors(design) yields every assignment of the inputs of design.
+def vectors(design: Netlist):
+    inputs = sorted(design.inputs)
+    for values in itertools.product([False, True], repeat=len(inputs)):
+        yield dict(zip(inputs, values))
+
+
+# chain(length) returns a netlist whose one output is length inverters in a row, and its input.
+def chain(length: int) -> Netlist:
+    design = Netlist()
+    id = design.input("a")
+    for _ in range(length):
+        id = design.add(eda_tree.NOT, [id])
+    design.outputs["y"] = id
+    return design
+
+
+@pytest.fixture(scope="module")
+def tech() -> technology.Technology:
+    # The library names its verilog relative to the repository.
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+        return technology.Technology("stdcells.json")
+    finally:
+        os.chdir(cwd)
+
+
+def test_share_merges_identical_nodes():
+    design = Netlist(share=True)
+    (a, b) = (design.input("a"), design.input("b"))
+    assert design.input("a") == a
+    assert design.add(eda_tree.AND, [a, b]) == design.add(eda_tree.AND, [b, a])
+    assert design.add(eda_tree.NOT, [a]) == design.add(eda_tree.NOT, [a])
+    assert len(design) == 4
+
+
+def test_without_share_every_node_is_new():
+    design = Netlist()
+    a = design.input("a")
+    assert design.add(eda_tree.NOT, [a]) != design.add(eda_tree.NOT, [a])
+    assert len(design) == 3
+
+
+def test_postorder_puts_fanins_first():
+    design = random_netlist(1)
+    order = design.postorder()
+    position = {id: i for (i, id) in enumerate(order)}
+    for id in order:
+        for fanin in design.children(id):
+            assert position[fanin] < position[id]
+
+
+def test_trim_drops_unused_nodes():
+    design = Netlist()
+    a = design.input("a")
+    design.add(eda_tree.NOT, [design.input("b")])
+    design.outputs["y"] = design.add(eda_tree.NOT, [a])
+    trimmed = design.trim()
+    assert len(trimmed) == 2
+    assert list(trimmed.inputs) == ["a"]
+    assert trimmed.simulate({"a": True}) == {"y": False}
+
+
+@pytest.mark.parametrize("seed", range(50))
+@pytest.mark.parametrize("share", [False, True])
+def test_trees_round_trip(seed: int, share: bool):
+    design = random_netlist(seed, share)
+    trees = design.to_trees()
+    rebuilt = netlist.from_trees(trees, share)
+    assert len(rebuilt) == len(design.trim())
+    for simdata in vectors(design):
+        assert rebuilt.simulate(simdata) == design.simulate(simdata)
+
+
+def test_views_look_like_trees():
+    design = random_netlist(2)
+    for (output, view) in design.roots().items():
+        tree = design.to_trees()[output]
+        assert [node.behavior.name for node in view.postorder()] == \
+            [node.behavior.name for node in tree.postorder()]
+
+
+def test_of_rejects_views_of_other_nodes():
+    design = random_netlist(3)
+    assert netlist.of(design.roots()) is design
+    with pytest.raises(ValueError):
+        netlist.of({"y": design.view(0)})
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_map_matches_simulation(seed: int, tech: technology.Technology):
+    (simplified, _) = rewrite.rewrite(
+        rewrite.rewrite(random_netlist(seed), rewrite.CANNONICALIZE)[0])
+    (mapped, _) = simplified.map(tech)
+    assert {mapped.type(id) for id in mapped.postorder()
+            if not id in mapped.names} <= {"stdcell"}
+    for simdata in vectors(simplified):
+        assert mapped.simulate(simdata, tech) == simplified.simulate(simdata)
+
+
+def test_deep_chain_without_recursion(tech: technology.Technology):
+    design = chain(100000)
+    assert len(design.trim()) == len(design)
+    assert len(design.postorder()) == len(design)
+    assert len(netlist.from_trees(design.to_trees())) == len(design)
+    (mapped, _) = design.map(tech)
+    assert mapped.simulate({"a": True}, tech) == {"y": True}
+
+
+def test_library_with_an_xor_cell(tmp_path):
+    with open(os.path.join(ROOT, "stdcells.json")) as f:
+        spec = json.load(f)
+    with open(os.path.join(ROOT, "stdcells.v")) as f:
+        verilog = f.read()
+    with open(tmp_path / "cells.v", "w") as f:
+        f.write(verilog + "\nmodule xor(input a, input b, output logic z);\n    assign z = a ^ b;\nendmodule\n")
+    spec["verilog"] = str(tmp_path / "cells.v")
+    spec["cells"].append(dict(spec["cells"][0], name="XOR", verilog_module="xor"))
+    with open(tmp_path / "cells.json", "w") as f:
+        json.dump(spec, f)
+    tech = technology.Technology(str(tmp_path / "cells.json"))
+
+    design = Netlist()
+    (a, b, c) = (design.input("a"), design.input("b"), design.input("c"))
+    design.outputs["y"] = design.add(eda_tree.XOR, [design.add(eda_tree.XOR, [a, b]), c])
+    # NAND(NAND(a, t), NAND(b, u)) has the shape of an XOR, but only is one when t and u are both NAND(a, b).
+    design.outputs["z"] = design.add(eda_tree.NAND, [design.add(eda_tree.NAND, [a, design.add(eda_tree.NAND, [a, b])]),
+                                                     design.add(eda_tree.NAND, [b, design.add(eda_tree.NAND, [a, c])])])
+    (simplified, _) = rewrite.rewrite(rewrite.rewrite(design, rewrite.CANNONICALIZE)[0])
+    (mapped, _) = simplified.map(tech)
+    cells = [mapped.behavior(id).name for id in mapped.postorder() if not id in mapped.names]
+    assert cells.count("XOR") == 2
+    for simdata in vectors(design):
+        assert mapped.simulate(simdata, tech) == design.simulate(simdata)
@@ -0,0 +1,101 @@
+import pytest
+import eda_tree
+import rewrite
+from netlist import Netlist
+from test_netlist import random_netlist, vectors
+
+
+# rewritten(design) returns design cannonicalized and then simplified, with the nodes each pass's rules eliminated.
+def rewritten(design: Netlist) -> tuple[Netlist, Netlist, dict[str, int], dict[str, int]]:
+    (cannonical, cannonicalized) = rewrite.rewrite(design, rewrite.CANNONICALIZE)
+    (simple, simplified) = rewrite.rewrite(cannonical)
+    return (cannonical, simple, cannonicalized, simplified)
+
+
+@pytest.mark.parametrize("seed", range(200))
+@pytest.mark.parametrize("share", [False, True])
+def test_rewriting_matches_simulation(seed: int, share: bool):
+    design = random_netlist(seed, share)
+    (cannonical, simple, _, _) = rewritten(design)
+    for result in [cannonical, simple]:
+        assert {result.behavior(id).name for id in result.postorder() if not id in result.names} \
+            <= rewrite.GATES
+    for simdata in vectors(design):
+        expected = design.simulate(simdata)
+        assert cannonical.simulate(simdata) == expected
+        assert simple.simulate(simdata) == expected
+
+
+@pytest.mark.parametrize("seed", range(200))
+@pytest.mark.parametrize("share", [False, True])
+def test_counts_add_up_to_the_size_change(seed: int, share: bool):
+    design = random_netlist(seed, share)
+    (cannonical, simple, cannonicalized, simplified) = rewritten(design)
+    assert sum(cannonicalized.values()) == len(design.trim()) - len(cannonical)
+    assert sum(simplified.values()) == len(cannonical) - len(simple)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_rewriting_reaches_a_fixed_point(seed: int):
+    (_, simple, _, _) = rewritten(random_netlist(seed, share=True))
+    (again, eliminated) = rewrite.rewrite(simple)
+    assert len(again) == len(simple)
+    assert set(eliminated.values()) == {0}
+
+
+def test_counts_per_rule():
+    design = Netlist()
+    (a, b) = (design.input("a"), design.input("b"))
+    design.outputs["y"] = design.add(eda_tree.OUTPUT, [design.add(eda_tree.AND, [a, b])])
+    (_, eliminated) = rewrite.rewrite(design, rewrite.CANNONICALIZE)
+    assert eliminated == {"buffer removal": 1, "NAND/NOT normalization": -1, "XOR decomposition": 0}
+
+    design = Netlist()
+    (a, b) = (design.input("a"), design.input("b"))
+    design.outputs["y"] = design.add(
+        eda_tree.NAND, [a, design.add(eda_tree.NOT, [design.add(eda_tree.NOT, [b])])])
+    (simple, eliminated) = rewrite.rewrite(design)
+    assert len(simple) == 3
+    assert eliminated["double negation"] == 2
+
+    # NAND(NAND(a, NOT a), b) is NAND(1, b), so a and everything reading it go.
+    design = Netlist()
+    (a, b) = (design.input("a"), design.input("b"))
+    one = design.add(eda_tree.NAND, [a, design.add(eda_tree.NOT, [a])])
+    design.outputs["y"] = design.add(eda_tree.NAND, [one, b])
+    (simple, eliminated) = rewrite.rewrite(design)
+    assert list(simple.inputs) == ["b"]
+    assert len(simple) == 2
+    assert eliminated["constant propagation"] == 3
+
+
+def test_constant_outputs_are_rebuilt_from_an_input():
+    design = Netlist()
+    a = design.input("a")
+    design.outputs["y"] = design.add(eda_tree.NAND, [a, design.add(eda_tree.NOT, [a])])
+    design.outputs["z"] = design.add(eda_tree.NOT, [design.outputs["y"]])
+    (simple, eliminated) = rewrite.rewrite(design)
+    assert sum(eliminated.values()) == len(design) - len(simple)
+    for simdata in vectors(design):
+        assert simple.simulate(simdata) == {"y": True, "z": False}
+
+
+def test_deep_chains_without_recursion():
+    design = Netlist()
+    id = design.input("a")
+    for _ in range(100001):
+        id = design.add(eda_tree.NOT, [id])
+    design.outputs["y"] = design.add(eda_tree.OUTPUT, [id])
+    (simple, eliminated) = rewrite.rewrite(design)
+    assert len(simple) == 2
+    assert sum(eliminated.values()) == len(design) - len(simple)
+    assert simple.simulate({"a": True}) == {"y": False}
+
+    design = Netlist()
+    id = design.input("x0")
+    for i in range(1, 20000):
+        id = design.add(eda_tree.XOR, [id, design.input(f"x{i}")])
+    design.outputs["y"] = id
+    (cannonical, _) = rewrite.rewrite(design, rewrite.CANNONICALIZE)
+    simdata = {f"x{i}": i % 3 == 0 for i in range(20000)}
+    assert cannonical.simulate(simdata) == {"y": sum(simdata.values()) % 2 == 1}